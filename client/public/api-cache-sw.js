@@ -0,0 +1,141 @@
+// Stale-while-revalidate caching of whitelisted API GETs, imported into the
+// generated service-worker.js by scripts/inject-sw.js at build time.
+
+// Cached responses are served right away while a conditional request (using
+// the server's ETag) refreshes the cache in the background. Pages are told
+// about refreshed responses with an 'api-cache-updated' message, see
+// onApiCacheUpdate in src/registerServiceWorker.js.
+
+const API_CACHE_NAME = 'api-cache-v1';
+const API_CACHE_MAX_ENTRIES = 50;
+// only GETs matching these are cached, writes to them invalidate the cache
+const API_CACHE_WHITELIST = [/^\/api\/users(\?.*)?$/];
+
+function isWhitelisted(url) {
+  const u = new URL(url);
+  return (
+    u.origin === self.location.origin &&
+    API_CACHE_WHITELIST.some(pattern => pattern.test(u.pathname + u.search))
+  );
+}
+
+function parseCacheControl(response) {
+  const directives = {};
+  (response.headers.get('cache-control') || '')
+    .split(',')
+    .map(d => d.trim().toLowerCase())
+    .filter(d => d)
+    .forEach(d => {
+      const [name, value] = d.split('=');
+      directives[name] = value === undefined ? true : value;
+    });
+  return directives;
+}
+
+function isCacheable(response) {
+  return response.ok && !parseCacheControl(response)['no-store'];
+}
+
+// Responses the server says are still fresh don't need revalidating
+function isFresh(response) {
+  const maxAge = parseInt(parseCacheControl(response)['max-age'], 10);
+  const date = Date.parse(response.headers.get('date'));
+  return maxAge > 0 && !isNaN(date) && Date.now() - date < maxAge * 1000;
+}
+
+// Cache keys are returned in insertion order, so evict from the front.
+// Entries are re-inserted on every refresh, making this least recently updated.
+function trimCache(cache) {
+  return cache.keys().then(keys => {
+    const excess = keys.length - API_CACHE_MAX_ENTRIES;
+    return Promise.all(keys.slice(0, Math.max(excess, 0)).map(k => cache.delete(k)));
+  });
+}
+
+function notifyClients(url) {
+  return self.clients.matchAll().then(clients =>
+    clients.forEach(client => client.postMessage({ type: 'api-cache-updated', url }))
+  );
+}
+
+function revalidate(request, cached) {
+  const headers = new Headers(request.headers);
+  const etag = cached && cached.headers.get('etag');
+  if (etag) {
+    headers.set('If-None-Match', etag);
+  }
+  return fetch(new Request(request.url, { headers, credentials: 'same-origin' }))
+    .then(response => {
+      if (response.status === 304 && cached) {
+        return cached;
+      }
+      return caches.open(API_CACHE_NAME).then(cache => {
+        if (!isCacheable(response)) {
+          return cache.delete(request).then(() => response);
+        }
+        const copy = response.clone();
+        return cache
+          .delete(request)
+          .then(() => cache.put(request, copy))
+          .then(() => trimCache(cache))
+          .then(() => cached && notifyClients(request.url))
+          .then(() => response);
+      });
+    });
+}
+
+function staleWhileRevalidate(event) {
+  return caches.open(API_CACHE_NAME).then(cache =>
+    cache.match(event.request).then(cached => {
+      if (!cached) {
+        return revalidate(event.request, null);
+      }
+      if (!isFresh(cached)) {
+        // keep the worker alive until the background refresh is done
+        event.waitUntil(revalidate(event.request, cached).catch(() => undefined));
+      }
+      return cached;
+    })
+  );
+}
+
+// Drop cached GETs of the written path before handing back the response, so
+// the page can't read back stale data.
+function invalidateAfterWrite(request) {
+  return fetch(request).then(response => {
+    if (!response.ok) {
+      return response;
+    }
+    const path = new URL(request.url).pathname;
+    return caches
+      .open(API_CACHE_NAME)
+      .then(cache =>
+        cache.keys().then(keys =>
+          Promise.all(
+            keys
+              .filter(k => new URL(k.url).pathname === path)
+              .map(k => cache.delete(k))
+          )
+        )
+      )
+      .then(() => response);
+  });
+}
+
+self.addEventListener('fetch', event => {
+  const { request } = event;
+  if (!isWhitelisted(request.url)) {
+    return;
+  }
+  if (request.method === 'GET') {
+    event.respondWith(staleWhileRevalidate(event));
+  } else {
+    event.respondWith(invalidateAfterWrite(request));
+  }
+});
+
+self.addEventListener('message', event => {
+  if (event.data && event.data.type === 'api-cache-clear') {
+    event.waitUntil(caches.delete(API_CACHE_NAME));
+  }
+});
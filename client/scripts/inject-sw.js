@@ -0,0 +1,15 @@
+// Imports our API caching (public/api-cache-sw.js) into the service worker
+// generated by react-scripts, which doesn't let us configure it otherwise.
+// Runs after `react-scripts build`, see the build script in package.json.
+
+const fs = require('fs');
+const path = require('path');
+
+const swPath = path.join(__dirname, '..', 'build', 'service-worker.js');
+const importLine = "importScripts('/static/api-cache-sw.js');\n";
+
+const sw = fs.readFileSync(swPath, 'utf8');
+if (sw.indexOf(importLine) === -1) {
+  fs.writeFileSync(swPath, importLine + sw);
+  console.log('Injected API cache into ' + swPath);
+}
@@ -8,6 +8,10 @@
 // To learn more about the benefits of this model, read https://goo.gl/KwvDNy.
 // This link also includes instructions on opting out of this behavior.
 
+// Whitelisted API GETs are also served stale-while-revalidate from the
+// service worker (see public/api-cache-sw.js), use onApiCacheUpdate to hear
+// about refreshed responses.
+
 const isLocalhost = Boolean(
   window.location.hostname === 'localhost' ||
     // [::1] is the IPv6 localhost address.
@@ -115,3 +119,25 @@ export function unregister() {
     });
   }
 }
+
+// Calls given callback with the url of an API response the service worker
+// refreshed in the background, returns a function that unsubscribes.
+export function onApiCacheUpdate(callback) {
+  if (!('serviceWorker' in navigator)) {
+    return () => {};
+  }
+  const listener = event => {
+    if (event.data && event.data.type === 'api-cache-updated') {
+      callback(event.data.url);
+    }
+  };
+  navigator.serviceWorker.addEventListener('message', listener);
+  return () => navigator.serviceWorker.removeEventListener('message', listener);
+}
+
+// Drops all API responses cached by the service worker, e.g. on signout.
+export function clearApiCache() {
+  if ('serviceWorker' in navigator && navigator.serviceWorker.controller) {
+    navigator.serviceWorker.controller.postMessage({ type: 'api-cache-clear' });
+  }
+}
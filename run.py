@@ -1,8 +1,30 @@
+import sys
+
 from werkzeug.serving import run_simple
-from werkzeug.wsgi import DispatcherMiddleware
 
 from server import api, frontend
 
-app = DispatcherMiddleware(frontend.create_app(), {
-        '/api': api.create_app()
-    })
\ No newline at end of file
+
+def create_app():
+    """Returns the frontend and api applications, combined. Api routes carry
+    their own '/api' prefix, so requests are handed over with the full path.
+    """
+    frontend_app = frontend.create_app()
+    api_app = api.create_app()
+
+    def app(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/api' or path.startswith('/api/'):
+            return api_app(environ, start_response)
+        return frontend_app(environ, start_response)
+    return app
+
+
+if __name__ == '__main__':
+    # e.g. python run.py serve --threads 8, see server.devserver
+    if sys.argv[1:2] != ['serve']:
+        sys.exit('usage: python run.py serve [--help]')
+    from server import devserver
+    devserver.serve(create_app, sys.argv[2:])
+else:
+    app = create_app()
@@ -4,9 +4,17 @@ import pkgutil
 
 from flask import Flask, Blueprint
 from flask.json import JSONEncoder
-from .helpers import JSONSerializableEncoder
+from .helpers import JSONSerializableEncoder, gzip_response
 from .config import load_settings, GAEDataStoreConfiguration
 from .security import oauth_factory
+from .tasks import task_runner
+from .cache import model_cache
+from .ratelimit import rate_limiter
+from .budgets import latency_budgets
+from .profiler import request_profiler
+from .retention import retention
+from .idempotency import idempotency_store
+from . import migrations
 from . import models
 
 
@@ -39,8 +47,26 @@ def create_app(pkg_name, pkg_path, override_settings=None):
     init_db(app)
     # initialize and load config settings
     load_settings(app, GAEDataStoreConfiguration, override_settings=override_settings)
+    # apply entity cache policies
+    init_cache(app)
     # initialize security
     init_security(app)
+    # initialize rate limits
+    init_rate_limits(app)
+    # initialize latency budgets
+    init_budgets(app)
+    # initialize idempotency keys for write routes
+    init_idempotency(app)
+    # initialize deferred tasks
+    init_tasks(app)
+    # initialize entity retention policies
+    init_retention(app)
+    # initialize entity migrations
+    init_migrations(app)
+    # initialize request profiling
+    init_profiler(app)
+    # initialize response compression
+    init_compression(app)
     # register blueprint modules
     _register_blueprints(app, pkg_name, pkg_path)
     return app
@@ -54,5 +80,86 @@ def init_security(app):
     oauth_factory.init_config(app.config['OAUTH'])
 
 
+def init_rate_limits(app):
+    """Configures rate limits for our routes.
+    """
+    if 'RATE_LIMITS' not in app.config:
+        raise RuntimeError('{} configuration missing!'.format('RATE_LIMITS'))
+    rate_limiter.init_config(app.config['RATE_LIMITS'])
+
+
+def init_idempotency(app):
+    """Configures idempotency keys for our write routes.
+    """
+    if 'IDEMPOTENCY' not in app.config:
+        raise RuntimeError('{} configuration missing!'.format('IDEMPOTENCY'))
+    idempotency_store.init_config(app.config['IDEMPOTENCY'])
+
+
+def init_budgets(app):
+    """Configures latency budgets for our routes.
+    """
+    if 'BUDGETS' not in app.config:
+        raise RuntimeError('{} configuration missing!'.format('BUDGETS'))
+    latency_budgets.init_config(app.config['BUDGETS'])
+
+
+def init_cache(app):
+    """Applies configured entity cache policies to our models.
+    """
+    if 'CACHE' not in app.config:
+        raise RuntimeError('{} configuration missing!'.format('CACHE'))
+    model_cache.init_config(app.config['CACHE'], models.AbstractModel.subclasses())
+
+
+def init_tasks(app):
+    """Configures the deferred task runner.
+    """
+    if 'TASKS' not in app.config:
+        raise RuntimeError('{} configuration missing!'.format('TASKS'))
+    task_runner.init_config(app.config['TASKS'])
+
+
+def init_retention(app):
+    """Sets up the configured retention policies for our models.
+    """
+    if 'RETENTION' not in app.config:
+        raise RuntimeError('{} configuration missing!'.format('RETENTION'))
+    retention.init_config(app.config['RETENTION'], models.AbstractModel.subclasses())
+
+
+def init_migrations(app):
+    """Configures the entity migration runner.
+    """
+    if 'MIGRATIONS' not in app.config:
+        raise RuntimeError('{} configuration missing!'.format('MIGRATIONS'))
+    migrations.init_config(app.config['MIGRATIONS'])
+
+
+def init_profiler(app):
+    """Configures on demand and sampled request profiling.
+    """
+    if 'PROFILER' not in app.config:
+        raise RuntimeError('{} configuration missing!'.format('PROFILER'))
+    request_profiler.init_config(app.config['PROFILER'], app.secret_key)
+    app.before_request(request_profiler.start)
+    app.teardown_request(request_profiler.stop)
+
+
+def init_compression(app):
+    """Configures gzip compression of responses.
+    """
+    config = app.config.get('COMPRESSION', {})
+    if not config.get('ENABLED', False):
+        return
+
+    @app.after_request
+    def compress(response):
+        return gzip_response(response,
+            min_size=config.get('MIN_SIZE', 1024),
+            level=config.get('LEVEL', 6),
+            mimetypes=config.get('MIMETYPES'))
+
+
 def init_db(app):
     pass
\ No newline at end of file
@@ -1,22 +1,32 @@
 import logging
 
-from flask import Blueprint, jsonify, request, Response
+from flask import Blueprint
+from ..serializers import respond, get_payload
 from ..models import User
+from .. import ratelimit, cache, idempotency, budgets
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
 @bp.route('/users', methods=['get'])
+@ratelimit.limit('API')
+# fallback responses must not get an ETag, they may be stale
+@budgets.budget('API_READ')
+@cache.conditional(User)
 def api_list_users():
    """
    Handles request for listing all users.
    """
-   return jsonify(User.list())
+   return respond(User.list())
 
 
 @bp.route('/users', methods=['post'])
+@ratelimit.limit('API')
+# duplicates wait for the first request within the budget
+@budgets.budget('API_WRITE')
+@idempotency.idempotent
 def api_create_user():
    """
    Handle creating a new user.
    """
-   data = request.get_json()
-   return jsonify(User.create(**data))
+   data = get_payload()
+   return respond(User.create(**data))
@@ -0,0 +1,131 @@
+"""
+    server.assets
+
+Collects the fingerprinted client build into our static folder and provides
+the manifest used for emitting asset urls. To collect a fresh client build:
+
+    $ cd client && npm run build && cd ..
+    $ python -m server.assets
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import shutil
+
+K_STATIC_DIR = 'STATIC_DIR'
+K_STATIC_URL = 'STATIC_URL'
+
+MANIFEST_NAME = 'asset-manifest.json'
+COMPRESSIBLE_EXTENSIONS = ('.js', '.css', '.map', '.json', '.svg', '.html', '.txt', '.ico')
+
+
+def _gzip_file(path, min_size=1024):
+    """Write a precompressed variant of file at given path next to it, if
+    it's worth compressing.
+
+    @param path path of file to compress
+    @param min_size files smaller than this (in bytes) are left alone
+    @returns True if a variant was written
+    """
+    if not path.endswith(COMPRESSIBLE_EXTENSIONS) or os.path.getsize(path) < min_size:
+        return False
+    with open(path, 'rb') as f_in:
+        # zero mtime keeps the output stable between identical builds
+        f_out = gzip.GzipFile(path + '.gz', 'wb', 9, mtime=0)
+        try:
+            shutil.copyfileobj(f_in, f_out)
+        finally:
+            f_out.close()
+    return True
+
+
+def collect(build_dir='client/build', static_dir='static', static_url='/static/'):
+    """Copies the client build into the static folder, writing precompressed
+    variants and our own manifest of asset name to url.
+
+    @param build_dir path to the client build
+    @param static_dir path to the static folder served by App Engine
+    @param static_url url the static folder is served under
+    @returns the manifest
+    """
+    with open(os.path.join(build_dir, MANIFEST_NAME)) as f:
+        build_manifest = json.load(f)
+
+    if os.path.isdir(static_dir):
+        shutil.rmtree(static_dir)
+    # fingerprinted assets live in build/static, everything else (favicon,
+    # web app manifest) is copied to the top of our static folder
+    shutil.copytree(os.path.join(build_dir, 'static'), static_dir)
+    for name in os.listdir(build_dir):
+        path = os.path.join(build_dir, name)
+        if os.path.isfile(path) and name not in (MANIFEST_NAME, 'index.html'):
+            shutil.copy2(path, static_dir)
+
+    compressed = 0
+    for root, _, files in os.walk(static_dir):
+        for name in files:
+            compressed += _gzip_file(os.path.join(root, name))
+
+    manifest = {}
+    for name, path in build_manifest.items():
+        # build paths are relative to build dir, e.g. static/js/main.1a2b3c.js
+        if path.startswith('static/'):
+            path = path[len('static/'):]
+        manifest[name] = static_url + path
+    with open(os.path.join(static_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    logging.info('Collected %s assets (%s precompressed) into %s',
+        len(manifest), compressed, static_dir)
+    return manifest
+
+
+class AssetManifest(object):
+    """Maps asset names (e.g. main.js) to their fingerprinted urls.
+    """
+    def __init__(self):
+        self.config = {}
+        self.assets = {}
+
+    def init_config(self, config):
+        """Load the manifest written by collect.
+
+        @param config ASSETS settings
+        """
+        self.config = dict(config)
+        path = os.path.join(config.get(K_STATIC_DIR, 'static'), MANIFEST_NAME)
+        try:
+            with open(path) as f:
+                self.assets = json.load(f)
+        except (IOError, ValueError) as e:
+            # e.g. running without a client build
+            logging.info('Unable to load asset manifest %s: %s', path, e)
+            self.assets = {}
+
+    def url_for(self, name):
+        """Returns the url for given asset, falling back to an unfingerprinted
+        url if the asset isn't in the manifest.
+
+        @param name name of asset (e.g. main.js)
+        """
+        if name in self.assets:
+            return self.assets[name]
+        return self.config.get(K_STATIC_URL, '/static/') + name
+
+    def __contains__(self, name):
+        return name in self.assets
+
+
+asset_manifest = AssetManifest()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collect client build into static folder')
+    parser.add_argument('--build-dir', default='client/build')
+    parser.add_argument('--static-dir', default='static')
+    parser.add_argument('--static-url', default='/static/')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    collect(args.build_dir, args.static_dir, args.static_url)
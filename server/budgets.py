@@ -0,0 +1,316 @@
+"""
+    server.budgets
+
+Latency budgets for routes. While a route with a budget runs, datastore RPCs
+(see AbstractModel) and OAuth provider calls get whatever is left of it as
+their deadline, so a slow backend can't hold a request thread for longer
+than its budget. Routes that run out of time fall back to the last good
+response, a degraded response, or fail fast with a 503.
+"""
+import logging
+import time
+
+from functools import wraps
+from flask import g, request, session, jsonify, current_app, has_app_context
+from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
+from google.appengine.runtime import apiproxy_errors
+from requests.exceptions import Timeout as HTTPTimeout
+from .cache import CacheStats
+from . import helpers, serializers
+
+K_ENABLED = 'ENABLED'
+K_ROUTES = 'ROUTES'
+K_BUDGET = 'BUDGET'
+K_FALLBACK = 'FALLBACK'
+K_MIN_DEADLINE = 'MIN_DEADLINE'
+K_HTTP_TIMEOUT = 'HTTP_TIMEOUT'
+K_FALLBACK_TIMEOUT = 'FALLBACK_TIMEOUT'
+K_FALLBACK_REFRESH = 'FALLBACK_REFRESH'
+K_STATS_FLUSH_INTERVAL = 'STATS_FLUSH_INTERVAL'
+
+FALLBACK_CACHED = 'CACHED'
+FALLBACK_DEGRADE = 'DEGRADE'
+FALLBACK_FAIL = 'FAIL'
+FALLBACKS = [FALLBACK_CACHED, FALLBACK_DEGRADE, FALLBACK_FAIL]
+
+H_FALLBACK = 'X-Budget-Fallback'
+
+# Events recorded per budget
+REQUEST = 'requests'
+# took longer than the budget
+OVERRUN = 'overruns'
+# backend call cut short, or not made since the budget was spent
+DATASTORE_TIMEOUT = 'datastore_timeouts'
+PROVIDER_TIMEOUT = 'provider_timeouts'
+EXHAUSTED = 'exhausted'
+# how requests out of time were answered
+SERVED_CACHED = 'served_cached'
+SERVED_DEGRADED = 'served_degraded'
+FAILED = 'failed'
+EVENTS = [REQUEST, OVERRUN, DATASTORE_TIMEOUT, PROVIDER_TIMEOUT, EXHAUSTED,
+    SERVED_CACHED, SERVED_DEGRADED, FAILED]
+
+
+class BudgetException(Exception):
+    """Generic latency budget related exception.
+    """
+    pass
+
+class BudgetExceeded(BudgetException):
+    """Raised instead of making a backend call once the budget is spent.
+    """
+    pass
+
+
+# errors raised by backend calls running out of time, and what they're counted as
+TIMEOUT_ERRORS = [
+    (BudgetExceeded, EXHAUSTED),
+    (datastore_errors.Timeout, DATASTORE_TIMEOUT),
+    (apiproxy_errors.DeadlineExceededError, DATASTORE_TIMEOUT),
+    (HTTPTimeout, PROVIDER_TIMEOUT),
+]
+
+
+class Budget(object):
+    """Time budget of a single request.
+    """
+    def __init__(self, name, seconds, fallback):
+        self.name = name
+        self.seconds = seconds
+        self.fallback = fallback
+        self.started_at = time.time()
+
+    def remaining(self):
+        return self.seconds - (time.time() - self.started_at)
+
+
+class BudgetStats(CacheStats):
+    """Counters per budget, kept in process and periodically flushed to
+    memcache (see CacheStats).
+    """
+    PREFIX = 'budget-stats:'
+
+    def get(self, names):
+        """Returns the aggregated counters per budget.
+
+        @param names list of budget names to report on
+        """
+        keys = ['{}:{}'.format(n, e) for n in names for e in EVENTS]
+        counts = memcache.get_multi(keys, key_prefix=self.PREFIX)
+        with self._lock:
+            for k, v in self._counts.items():
+                counts[k] = counts.get(k, 0) + v
+        report = {}
+        for name in names:
+            stats = dict((e, counts.get('{}:{}'.format(name, e), 0)) for e in EVENTS)
+            stats['overrun_rate'] = float(stats[OVERRUN]) / stats[REQUEST] if stats[REQUEST] else None
+            report[name] = stats
+        return report
+
+
+class LatencyBudgets(object):
+    """Registry of configured budgets, and source of deadlines for backend
+    calls made by the current request.
+    """
+    FALLBACK_PREFIX = 'budget-fallback:'
+    # marks fallbacks kept recently enough, see LatencyBudgets.remember
+    FRESH_PREFIX = 'budget-fallback-fresh:'
+    # larger responses don't fit in memcache
+    MAX_FALLBACK_SIZE = memcache.MAX_VALUE_SIZE
+
+    def __init__(self):
+        self.enabled = False
+        self.budgets = {}
+        self.min_deadline = 0.05
+        self.http_timeout = 10
+        self.fallback_timeout = 3600
+        self.fallback_refresh = 60
+        self.stats = BudgetStats()
+
+    def init_config(self, config):
+        """Initialize budgets from settings.
+
+        @param config BUDGETS settings
+        """
+        self.enabled = config.get(K_ENABLED, False)
+        self.min_deadline = config.get(K_MIN_DEADLINE, self.min_deadline)
+        self.http_timeout = config.get(K_HTTP_TIMEOUT, self.http_timeout)
+        self.fallback_timeout = config.get(K_FALLBACK_TIMEOUT, self.fallback_timeout)
+        self.fallback_refresh = config.get(K_FALLBACK_REFRESH, self.fallback_refresh)
+        self.stats.flush_interval = config.get(K_STATS_FLUSH_INTERVAL, self.stats.flush_interval)
+        self.budgets = {}
+        for name, c in (config.get(K_ROUTES) or {}).items():
+            fallback = c.get(K_FALLBACK, FALLBACK_FAIL)
+            if fallback not in FALLBACKS:
+                raise BudgetException('Unknown fallback {} for budget {}'.format(fallback, name))
+            self.budgets[name] = (c[K_BUDGET], fallback)
+
+    def get_budget(self, name):
+        if name not in self.budgets:
+            raise BudgetException('Latency budget {} not found!'.format(name))
+        return self.budgets[name]
+
+    def current(self):
+        """Returns the Budget of the current request, None if it has none.
+        """
+        return g.get('budget') if has_app_context() else None
+
+    def deadline(self):
+        """Returns the seconds left for a backend call, None when not within a
+        budget (e.g. in a task).
+
+        @raises BudgetExceeded if too little of the budget is left for a call
+        """
+        budget = self.current()
+        if budget is None:
+            return None
+        remaining = budget.remaining()
+        if remaining < self.min_deadline:
+            raise BudgetExceeded('Budget {} spent'.format(budget.name))
+        return remaining
+
+    def datastore_options(self):
+        """Returns the ndb options for a datastore call, i.e. its deadline.
+        """
+        deadline = self.deadline()
+        return {} if deadline is None else dict(deadline=deadline)
+
+    def provider_timeout(self):
+        """Returns the timeout for an HTTP call to an OAuth provider.
+        """
+        deadline = self.deadline()
+        return self.http_timeout if deadline is None else min(deadline, self.http_timeout)
+
+    def _fallback_key(self, name):
+        # responses may depend on the user and the negotiated format
+        return '{}{}:{}:{}:{}'.format(self.FALLBACK_PREFIX, name, session.get('user', ''),
+            serializers.registry.best_match().name, request.full_path)
+
+    def remember(self, name, resp):
+        """Keep given (good) response around to fall back on, unless it was
+        kept less than FALLBACK_REFRESH seconds ago. Streamed responses are
+        kept once fully sent, rather than buffering them.
+        """
+        key = self._fallback_key(name)
+        # add fails while the kept response is fresh (or memcache is down)
+        if not memcache.add(self.FRESH_PREFIX + key, True, time=self.fallback_refresh):
+            return
+        if not resp.is_streamed:
+            self._keep(name, key, resp.get_data(), resp.mimetype)
+            return
+        # the generator may run after the request context is gone
+        resp.response = self._tee(name, key, resp.iter_encoded(), resp.response, resp.mimetype)
+
+    def _tee(self, name, key, chunks, source, mimetype):
+        body, size = [], 0
+        try:
+            for chunk in chunks:
+                if body is not None:
+                    size += len(chunk)
+                    if size > self.MAX_FALLBACK_SIZE:
+                        # too large for memcache, stop collecting
+                        body = None
+                    else:
+                        body.append(chunk)
+                yield chunk
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+        # only reached if the whole body was sent
+        if body is None:
+            logging.info('Unable to keep response for budget %s: over %s bytes', name, size)
+            return
+        self._keep(name, key, b''.join(body), mimetype)
+
+    def _keep(self, name, key, body, mimetype):
+        try:
+            memcache.set(key, (body, mimetype), time=self.fallback_timeout)
+        except ValueError as e:
+            # too large for memcache
+            logging.info('Unable to keep response for budget %s: %s', name, e)
+
+    def fall_back(self, budget, degrade=None):
+        """Returns the response for a request that ran out of time, according
+        to its budget's fallback.
+
+        @param budget the Budget of the request
+        @param degrade optional function returning a degraded response
+        """
+        if budget.fallback == FALLBACK_CACHED:
+            cached = memcache.get(self._fallback_key(budget.name))
+            if cached is not None:
+                self.stats.record(budget.name, SERVED_CACHED)
+                body, mimetype = cached
+                resp = current_app.response_class(body, mimetype=mimetype)
+                resp.headers[H_FALLBACK] = 'cached'
+                return resp
+        if budget.fallback in (FALLBACK_CACHED, FALLBACK_DEGRADE) and degrade is not None:
+            self.stats.record(budget.name, SERVED_DEGRADED)
+            resp = current_app.make_response(degrade())
+            resp.headers[H_FALLBACK] = 'degraded'
+            return resp
+        self.stats.record(budget.name, FAILED)
+        return _service_unavailable()
+
+    def get_stats(self):
+        """Returns the counters of each configured budget.
+        """
+        return self.stats.get(sorted(self.budgets.keys()))
+
+
+latency_budgets = LatencyBudgets()
+
+
+def _service_unavailable():
+    """Respond with a 503 according to acceptable mimetypes.
+    """
+    if helpers.use_json_mimetype():
+        resp = jsonify({'message': 'Service Unavailable'})
+    else:
+        resp = current_app.response_class('Service Unavailable',
+            mimetype=helpers.MIME_TYPE_TEXT_HTML)
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '1'
+    return resp
+
+
+def _timeout_event(e):
+    for error_class, event in TIMEOUT_ERRORS:
+        if isinstance(e, error_class):
+            return event
+
+
+def budget(name, degrade=None):
+    """Decorates given function with the named latency budget, backend calls
+    it makes get their deadline from what's left of it.
+
+    @param name name of a budget configured in BUDGETS.ROUTES
+    @param degrade optional function returning a degraded response, used by
+                   the DEGRADE fallback (and CACHED, without a cached response)
+    """
+    timeout_errors = tuple(error_class for error_class, _ in TIMEOUT_ERRORS)
+
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            if not latency_budgets.enabled:
+                return fn(*args, **kwargs)
+            seconds, fallback = latency_budgets.get_budget(name)
+            _budget = g.budget = Budget(name, seconds, fallback)
+            try:
+                resp = current_app.make_response(fn(*args, **kwargs))
+            except timeout_errors as e:
+                logging.warn('Request out of time for budget %s: %r', name, e)
+                latency_budgets.stats.record(name, _timeout_event(e))
+                return latency_budgets.fall_back(_budget, degrade)
+            finally:
+                g.pop('budget', None)
+                latency_budgets.stats.record(name, REQUEST)
+                if _budget.remaining() < 0:
+                    latency_budgets.stats.record(name, OVERRUN)
+            if fallback == FALLBACK_CACHED and resp.status_code == 200:
+                latency_budgets.remember(name, resp)
+            return resp
+        return decorator
+    return wrapper
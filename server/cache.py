@@ -0,0 +1,477 @@
+"""
+    server.cache
+"""
+import logging
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from flask import request, current_app
+from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from . import serializers
+
+K_MODELS = 'MODELS'
+K_USE_CACHE = 'USE_CACHE'
+K_USE_MEMCACHE = 'USE_MEMCACHE'
+K_MEMCACHE_TIMEOUT = 'MEMCACHE_TIMEOUT'
+K_NEGATIVE_CACHE_TIMEOUT = 'NEGATIVE_CACHE_TIMEOUT'
+K_QUERY_CACHE_TIMEOUT = 'QUERY_CACHE_TIMEOUT'
+K_TRACK_GENERATION = 'TRACK_GENERATION'
+K_STATS_FLUSH_INTERVAL = 'STATS_FLUSH_INTERVAL'
+K_LEASE_TIMEOUT = 'LEASE_TIMEOUT'
+K_SETTLE_TIME = 'SETTLE_TIME'
+
+# Events recorded for each lookup by id/key, by where it was answered
+CONTEXT_HIT = 'context_hit'
+MEMCACHE_HIT = 'memcache_hit'
+NEGATIVE_HIT = 'negative_hit'
+# went to the datastore, a MISS when nothing was found there either
+LOOKUP = 'lookup'
+MISS = 'miss'
+# Events recorded for cached queries
+QUERY_HIT = 'query_hit'
+QUERY_MISS = 'query_miss'
+EVENTS = [CONTEXT_HIT, MEMCACHE_HIT, NEGATIVE_HIT, LOOKUP, MISS, QUERY_HIT, QUERY_MISS]
+
+
+class CachePolicy(object):
+    """Entity cache policy for a model class. In-context cache, memcache and
+    memcache timeout map onto the ndb class level policy attributes, negative
+    caching remembers ids that were not found for a while and query caching
+    keeps query results in memcache until the kind changes.
+    """
+    def __init__(self, use_cache=True, use_memcache=True, memcache_timeout=0,
+            negative_cache_timeout=0, query_cache_timeout=0, track_generation=False):
+        """
+        @param use_cache use the ndb in-context cache
+        @param use_memcache use memcache for entities
+        @param memcache_timeout seconds entities are kept in memcache, 0 for no expiration
+        @param negative_cache_timeout seconds a miss is remembered, 0 to disable
+        @param query_cache_timeout seconds query results are kept, 0 to disable
+        @param track_generation have writes move the kind on to its next
+                                generation (see ModelCache.generation), implied
+                                by query caching
+        """
+        self.use_cache = use_cache
+        self.use_memcache = use_memcache
+        self.memcache_timeout = memcache_timeout
+        self.negative_cache_timeout = negative_cache_timeout
+        self.query_cache_timeout = query_cache_timeout
+        self.track_generation = track_generation or bool(query_cache_timeout)
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates a policy from settings.
+
+        @param config dictionary of cache settings for a model
+        """
+        return cls(use_cache=config.get(K_USE_CACHE, True),
+            use_memcache=config.get(K_USE_MEMCACHE, True),
+            memcache_timeout=config.get(K_MEMCACHE_TIMEOUT, 0),
+            negative_cache_timeout=config.get(K_NEGATIVE_CACHE_TIMEOUT, 0),
+            query_cache_timeout=config.get(K_QUERY_CACHE_TIMEOUT, 0),
+            track_generation=config.get(K_TRACK_GENERATION, False))
+
+    def apply(self, model_class):
+        """Apply this policy to given model class.
+
+        @param model_class ndb.Model class to apply policy to
+        """
+        model_class._use_cache = self.use_cache
+        model_class._use_memcache = self.use_memcache
+        model_class._memcache_timeout = self.memcache_timeout
+
+    def __repr__(self):
+        return 'CachePolicy(%s)' % self.__dict__
+
+
+class CacheStats(object):
+    """Lookup counters per model kind. Counters are kept in process and
+    periodically flushed to memcache, so they aggregate across instances
+    without costing a memcache call per lookup.
+    """
+    PREFIX = 'cache-stats:'
+
+    def __init__(self, flush_interval=100):
+        self.flush_interval = flush_interval
+        self._counts = defaultdict(int)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def record(self, kind, event):
+        """Record a lookup event for given kind.
+
+        @param kind the model kind
+        @param event one of EVENTS
+        """
+        with self._lock:
+            self._counts['{}:{}'.format(kind, event)] += 1
+            self._pending += 1
+            if self._pending < self.flush_interval:
+                return
+            counts, self._counts, self._pending = self._counts, defaultdict(int), 0
+        self._flush(counts)
+
+    def flush(self):
+        """Flush in process counters to memcache.
+        """
+        with self._lock:
+            counts, self._counts, self._pending = self._counts, defaultdict(int), 0
+        self._flush(counts)
+
+    def _flush(self, counts):
+        if counts:
+            memcache.offset_multi(dict(counts), key_prefix=self.PREFIX, initial_value=0)
+
+    def get(self, kinds):
+        """Returns the aggregated counters and hit rates per kind, along with
+        the global memcache statistics. The hit rate counts lookups answered
+        without the datastore, the memcache hit rate those answered by
+        memcache out of the ones that got to it.
+
+        @param kinds list of model kinds to report on
+        """
+        keys = ['{}:{}'.format(k, e) for k in kinds for e in EVENTS]
+        counts = memcache.get_multi(keys, key_prefix=self.PREFIX)
+        with self._lock:
+            for k, v in self._counts.items():
+                counts[k] = counts.get(k, 0) + v
+        report = {}
+        for kind in kinds:
+            stats = dict((e, counts.get('{}:{}'.format(kind, e), 0)) for e in EVENTS)
+            total = stats[CONTEXT_HIT] + stats[MEMCACHE_HIT] + stats[NEGATIVE_HIT] + stats[LOOKUP]
+            hits = stats[CONTEXT_HIT] + stats[MEMCACHE_HIT] + stats[NEGATIVE_HIT]
+            stats['hit_rate'] = float(hits) / total if total else None
+            reached = stats[MEMCACHE_HIT] + stats[LOOKUP]
+            stats['memcache_hit_rate'] = float(stats[MEMCACHE_HIT]) / reached if reached else None
+            report[kind] = stats
+        return dict(models=report, memcache=memcache.get_stats())
+
+
+class _Call(object):
+    """A computation in flight, see SingleFlight.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Makes sure only one caller at a time recomputes a missed cache entry,
+    the others wait for it rather than all hitting the datastore. Callers
+    within the instance wait on a lock per key, across instances the caller
+    holding a short memcache lease does the work while the others poll the
+    cache for its result.
+    """
+    LEASE_PREFIX = 'singleflight:'
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, lease_timeout=5):
+        """
+        @param lease_timeout seconds a caller gets to compute a key before
+                             others stop waiting and compute it themselves
+        """
+        self.lease_timeout = lease_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, lookup=None, lease=True, deadline=None):
+        """Returns the result of fn, unless another caller is computing the
+        same key, then returns its result once done.
+
+        @param key identifies the computation
+        @param fn function computing the result (and caching it)
+        @param lookup optional function returning the cached result, or None,
+                      so callers that waited get their own copy (unless the
+                      result was None)
+        @param lease also coordinate with other instances, lookup should then
+                     only read memcache as it's polled
+        @param deadline optional seconds the caller has left, e.g. of its
+                        latency budget, waits for other callers are capped by it
+        @raises datastore_errors.Timeout if the deadline passed while waiting
+        """
+        wait = self.lease_timeout if deadline is None else min(deadline, self.lease_timeout)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(wait):
+                if wait < self.lease_timeout:
+                    raise datastore_errors.Timeout('Out of time waiting for {}'.format(key))
+                # taking too long, don't hold up the request any longer
+                return fn()
+            if call.error is not None:
+                raise call.error
+            if call.result is None:
+                return None
+            rv = lookup() if lookup is not None else None
+            return call.result if rv is None else rv
+
+        try:
+            call.result = self._lead(key, fn, lookup if lease else None, wait)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _lead(self, key, fn, lookup, wait):
+        if lookup is None:
+            return fn()
+        lease_key = self.LEASE_PREFIX + key
+        deadline = time.time() + wait
+        leased = memcache.add(lease_key, True, time=self.lease_timeout)
+        # add also fails if memcache is unavailable, only wait on an actual lease
+        while not leased and memcache.get(lease_key) is not None:
+            if time.time() >= deadline:
+                if wait < self.lease_timeout:
+                    raise datastore_errors.Timeout('Out of time waiting for {}'.format(key))
+                break
+            time.sleep(self.POLL_INTERVAL)
+            rv = lookup()
+            if rv is not None:
+                return rv
+            leased = memcache.add(lease_key, True, time=self.lease_timeout)
+        try:
+            return fn()
+        finally:
+            if leased:
+                memcache.delete(lease_key)
+
+
+class ModelCache(object):
+    """Holds the cache policies per model kind and takes care of negative
+    caching and lookup statistics.
+    """
+    NEGATIVE_PREFIX = 'cache-miss:'
+    GENERATION_PREFIX = 'cache-generation:'
+    UNSETTLED_PREFIX = 'cache-unsettled:'
+    QUERY_PREFIX = 'cache-query:'
+
+    def __init__(self):
+        self.policies = {}
+        # kinds whose generation anything depends on, others aren't bumped
+        self.tracked = set()
+        self.settle_time = 0
+        self.stats = CacheStats()
+        self.single_flight = SingleFlight()
+        self._batches = threading.local()
+
+    def init_config(self, config, model_classes):
+        """Apply configured cache policies to given model classes, models
+        without a configured policy keep the ndb defaults.
+
+        @param config CACHE settings
+        @param model_classes list of model classes
+        """
+        self.stats.flush_interval = config.get(K_STATS_FLUSH_INTERVAL, self.stats.flush_interval)
+        self.single_flight.lease_timeout = config.get(K_LEASE_TIMEOUT, self.single_flight.lease_timeout)
+        self.settle_time = config.get(K_SETTLE_TIME, self.settle_time)
+        model_configs = config.get(K_MODELS) or {}
+        for model_class in model_classes:
+            kind = model_class._get_kind()
+            if kind.upper() in model_configs:
+                policy = CachePolicy.from_config(model_configs[kind.upper()])
+                policy.apply(model_class)
+                self.policies[kind] = policy
+                if policy.track_generation:
+                    self.tracked.add(kind)
+                logging.debug('Applied %s to %s', policy, kind)
+
+    def get(self, key, **ctx_options):
+        """Get the entity for given key, going through negative caching and
+        recording lookup statistics.
+
+        @param key ndb.Key of entity to get
+        @param ctx_options ndb options for the get, e.g. its deadline
+        """
+        kind = key.kind()
+        policy = self.policies.get(kind)
+        negative_timeout = policy.negative_cache_timeout if policy else 0
+        if negative_timeout and memcache.get(self.NEGATIVE_PREFIX + key.urlsafe()):
+            self.stats.record(kind, NEGATIVE_HIT)
+            return None
+        # ndb doesn't report where an entity came from, peek at the context cache
+        in_context = key in ndb.get_context()._cache
+        get = lambda: key.get(**ctx_options)
+        if in_context or not (policy and policy.use_memcache) or ndb.in_transaction():
+            entity, event = get(), CONTEXT_HIT if in_context else LOOKUP
+        else:
+            # memcache only first, a miss costs a second memcache get below
+            cached = lambda: key.get(use_datastore=False, **ctx_options)
+            entity, event = cached(), MEMCACHE_HIT
+            if entity is None:
+                # concurrent misses (across instances too) wait for one of them
+                # to fill memcache, then each get their own copy from there
+                entity, event = self.single_flight.do('entity:' + key.urlsafe(), get,
+                    lookup=cached, deadline=ctx_options.get('deadline')), LOOKUP
+        self.stats.record(kind, event)
+        if entity is None:
+            self.stats.record(kind, MISS)
+            if negative_timeout:
+                memcache.set(self.NEGATIVE_PREFIX + key.urlsafe(), True, time=negative_timeout)
+        return entity
+
+    def forget_miss(self, key):
+        """Clear a remembered miss for given key, e.g. after it was saved.
+
+        @param key ndb.Key of entity
+        """
+        policy = self.policies.get(key.kind())
+        if policy and policy.negative_cache_timeout:
+            memcache.delete(self.NEGATIVE_PREFIX + key.urlsafe())
+
+    def query(self, kind, name, fetch, deadline=None):
+        """Returns the results of a query over given kind, served from memcache
+        if the kind has query caching enabled. Cached results are keyed by the
+        kind's generation, so any write to the kind invalidates them. Results
+        aren't cached until writes settled, as queries may not see them yet.
+
+        @param kind the model kind being queried
+        @param name identifies the query (including its parameters) within kind
+        @param fetch function that runs the query and returns its results
+        @param deadline optional seconds left for the query, see SingleFlight.do
+        """
+        policy = self.policies.get(kind)
+        timeout = policy.query_cache_timeout if policy else 0
+        if not timeout:
+            return fetch()
+        gen = self.generation(kind, settled=True)
+        if gen is None:
+            return fetch()
+        key = '{}{}:{}:{}'.format(self.QUERY_PREFIX, kind, gen, name)
+        results = memcache.get(key)
+        if results is not None:
+            self.stats.record(kind, QUERY_HIT)
+            return results
+        self.stats.record(kind, QUERY_MISS)
+
+        def fetch_and_cache():
+            results = fetch()
+            try:
+                memcache.set(key, results, time=timeout)
+            except ValueError as e:
+                # too large for memcache
+                logging.info('Unable to cache results of %s: %s', key, e)
+            return results
+        return self.single_flight.do(key, fetch_and_cache, lookup=lambda: memcache.get(key),
+            deadline=deadline)
+
+    def generation(self, kind, settled=False):
+        """Returns the current generation of given kind, it changes whenever
+        an entity of the kind is written or deleted. Global queries are
+        eventually consistent, for SETTLE_TIME seconds after a write they may
+        not reflect it yet, so anything derived from them shouldn't be tied to
+        the new generation until then.
+
+        @param kind the model kind
+        @param settled return None while recent writes may be missing from queries
+        """
+        key = self.GENERATION_PREFIX + kind
+        values = memcache.get_multi([key, self.UNSETTLED_PREFIX + kind])
+        if settled and self.UNSETTLED_PREFIX + kind in values:
+            return None
+        gen = values.get(key)
+        if gen is None:
+            # never set or evicted, start from a value older generations can't match
+            gen = int(time.time() * 1000)
+            if not memcache.add(key, gen):
+                gen = memcache.get(key) or gen
+        return gen
+
+    def track(self, kind):
+        """Have writes to given kind move it on to its next generation, e.g.
+        for a conditional route depending on it.
+
+        @param kind the model kind
+        """
+        self.tracked.add(kind)
+
+    def bump_generation(self, kind):
+        """Move given kind on to its next generation, if it's tracked.
+
+        @param kind the model kind
+        """
+        if kind not in self.tracked:
+            return
+        pending = getattr(self._batches, 'kinds', None)
+        if pending is not None:
+            pending.add(kind)
+            return
+        self._bump(kind)
+
+    def _bump(self, kind):
+        memcache.incr(self.GENERATION_PREFIX + kind)
+        if self.settle_time:
+            memcache.set(self.UNSETTLED_PREFIX + kind, True, time=self.settle_time)
+
+    @contextmanager
+    def batch_generations(self):
+        """Context manager that holds back generation bumps until it exits,
+        then bumps each written kind once, e.g. around ndb.put_multi which
+        would otherwise bump it for every entity.
+        """
+        if getattr(self._batches, 'kinds', None) is not None:
+            # nested batch, outer batch will take care of it
+            yield
+            return
+        self._batches.kinds = set()
+        try:
+            yield
+        finally:
+            kinds, self._batches.kinds = self._batches.kinds, None
+            for kind in kinds:
+                self._bump(kind)
+
+    def get_stats(self):
+        """Returns the lookup statistics for models with a cache policy.
+        """
+        return self.stats.get(sorted(self.policies.keys()))
+
+
+model_cache = ModelCache()
+
+
+def conditional(*model_classes):
+    """Decorates a GET route whose response only depends on entities of given
+    model classes. Responses get an ETag derived from the generation of each
+    model (and the negotiated response format), so clients revalidating with
+    If-None-Match get a 304 without the route touching the datastore. Right
+    after a write responses get no ETag, they may not reflect it yet (see
+    ModelCache.generation).
+
+    @param model_classes model classes the response depends on
+    """
+    for model_class in model_classes:
+        model_cache.track(model_class._get_kind())
+
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            gens = [model_cache.generation(m._get_kind(), settled=True) for m in model_classes]
+            etag = None if None in gens else \
+                '-'.join([serializers.registry.best_match().name] + [str(g) for g in gens])
+            # compressed responses carry the same ETag, weak (see helpers.gzip_response)
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                resp = current_app.response_class(status=304)
+            else:
+                resp = current_app.make_response(fn(*args, **kwargs))
+            if etag is not None:
+                resp.set_etag(etag)
+            # clients may keep it, as long as they revalidate
+            resp.cache_control.private = True
+            resp.cache_control.no_cache = True
+            return resp
+        return decorator
+    return wrapper
@@ -3,9 +3,15 @@ import logging
 from core import Configuration
 from ..models import Setting
 
+PLACE_HOLDER = '__REPLACE_ME__'
+
 class GAEDataStoreConfiguration(Configuration):
+    # ids of the settings looked up in the datastore by this process, see
+    # server.retention for pruning placeholders no longer referenced
+    referenced_ids = set()
+
     def __init__(self, **kwargs):
-        self.place_holder = '__REPLACE_ME__'
+        self.place_holder = PLACE_HOLDER
         super(GAEDataStoreConfiguration, self).__init__(**kwargs)
 
     def resolve_settings(self, settings):
@@ -47,6 +53,7 @@ class GAEDataStoreConfiguration(Configuration):
         """Return setting from datastore with given id/key. If the setting
         is missing, put a place holder in it's place.
         """
+        self.referenced_ids.add(id)
         setting = Setting.get_by_id(id)
         if setting is None:
             setting = Setting.create(id=id, value=self.place_holder)
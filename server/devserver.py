@@ -0,0 +1,288 @@
+"""
+    server.devserver
+
+Local multi-process server resembling production concurrency: the application
+is built (preloaded) once, then N worker processes are forked, each serving
+requests from a pool of T threads on a shared listening socket.
+
+    $ python run.py serve --api-server localhost:8000 --workers 4 --threads 8
+
+Workers only share memcache (and datastore transactions) through the API
+server of a dev_appserver.py, with local stubs a single worker is run.
+
+Signals sent to the master process:
+  - SIGHUP reloads, the master re-executes itself (keeping the listening
+    socket) and stops old workers once they've finished in-flight requests
+  - SIGTERM/SIGINT stops workers gracefully, then exits
+"""
+import argparse
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from google.appengine.ext import ndb, testbed
+from werkzeug.serving import BaseWSGIServer
+
+ENV_LISTEN_FD = 'DEVSERVER_LISTEN_FD'
+ENV_OLD_WORKERS = 'DEVSERVER_OLD_WORKERS'
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server handling requests on a bounded pool of threads.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, **kwargs):
+        super(PooledWSGIServer, self).__init__(host, port, app, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        # let in-flight requests finish
+        self.pool.shutdown(wait=True)
+        super(PooledWSGIServer, self).server_close()
+
+
+def fresh_ndb_context(app):
+    """Wraps given WSGI app so each request gets a new ndb context, as it does
+    on App Engine. Otherwise pooled threads would share cached entities
+    across requests.
+    """
+    def wrapped(environ, start_response):
+        ndb.set_context(None)
+        return app(environ, start_response)
+    return wrapped
+
+
+class Stubs(object):
+    """Sets up the App Engine APIs for a process, either testbed stubs with a
+    datastore kept in a sqlite file, or remote stubs talking to the API server
+    of a running dev_appserver.py (e.g. one backed by the datastore emulator).
+    Testbed stubs are per process, memcache and datastore transactions aren't
+    shared with other processes.
+    """
+    def __init__(self, api_server=None, datastore_path=None, app_id='dev~gae-python-starter'):
+        self.api_server = api_server
+        self.datastore_path = datastore_path
+        self.app_id = app_id
+        self._testbed = None
+
+    def activate(self):
+        os.environ.setdefault('APPLICATION_ID', self.app_id)
+        if self.api_server:
+            from google.appengine.ext.remote_api import remote_api_stub
+            remote_api_stub.ConfigureRemoteApi(self.app_id, '/',
+                lambda: ('', ''), servername=self.api_server)
+        else:
+            self._testbed = testbed.Testbed()
+            self._testbed.activate()
+            self._testbed.setup_env(app_id=self.app_id, overwrite=True)
+            self._testbed.init_datastore_v3_stub(datastore_file=self.datastore_path,
+                use_sqlite=True, require_indexes=False)
+            self._testbed.init_memcache_stub()
+            self._testbed.init_taskqueue_stub()
+            self._testbed.init_urlfetch_stub()
+
+    def deactivate(self):
+        if self._testbed is not None:
+            self._testbed.deactivate()
+            self._testbed = None
+
+
+class Master(object):
+    def __init__(self, create_app, options):
+        self.create_app = create_app
+        self.options = options
+        self.stubs = Stubs(options.api_server, options.datastore_path)
+        self.workers = set()
+        self.old_workers = set()
+        self.reloading = False
+        self.stopping = False
+        self.socket = None
+        self.app = None
+
+    def _listen(self):
+        fd = os.environ.pop(ENV_LISTEN_FD, None)
+        if fd is not None:
+            # inherited from the master we replaced on reload
+            self.socket = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+            os.close(int(fd))
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((self.options.host, self.options.port))
+            self.socket.listen(self.options.backlog)
+        old = os.environ.pop(ENV_OLD_WORKERS, '')
+        self.old_workers = set(int(pid) for pid in old.split(',') if pid)
+
+    def _preload(self):
+        start = time.time()
+        # stubs are only needed while building the app, each worker sets up
+        # its own so connections (e.g. sqlite) aren't shared across forks
+        self.stubs.activate()
+        try:
+            self.app = fresh_ndb_context(self.create_app())
+        finally:
+            self.stubs.deactivate()
+        logging.info('Preloaded app in %.1f ms', (time.time() - start) * 1000)
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return
+        # in worker
+        try:
+            Worker(self.app, self.socket, self.stubs, self.options).run()
+        except Exception:
+            logging.exception('Worker %s failed', os.getpid())
+            os._exit(1)
+        os._exit(0)
+
+    def _stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _handle_hup(self, signum, frame):
+        self.reloading = True
+
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping and not self.reloading:
+                    logging.warn('Worker %s exited (%s), replacing it', pid, status)
+                    self._spawn_worker()
+            self.old_workers.discard(pid)
+
+    def _reload(self):
+        # current workers keep serving until the new master has its own up
+        logging.info('Reloading')
+        os.environ[ENV_LISTEN_FD] = str(self.socket.fileno())
+        os.environ[ENV_OLD_WORKERS] = ','.join(str(pid) for pid in self.workers | self.old_workers)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def run(self):
+        self._listen()
+        self._preload()
+        signal.signal(signal.SIGHUP, self._handle_hup)
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        for _ in range(self.options.workers):
+            self._spawn_worker()
+        # new workers are up and accepting, let the previous generation go
+        self._stop_workers(self.old_workers)
+        logging.info('Serving on http://%s:%s with %s workers x %s threads (master %s)',
+            self.options.host, self.options.port, self.options.workers,
+            self.options.threads, os.getpid())
+
+        while not self.stopping:
+            if self.reloading:
+                self._reload()
+            self._reap()
+            time.sleep(0.2)
+
+        logging.info('Stopping workers')
+        self._stop_workers(self.workers | self.old_workers)
+        deadline = time.time() + self.options.graceful_timeout
+        while (self.workers or self.old_workers) and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        self._stop_workers(self.workers | self.old_workers)
+
+
+class Worker(object):
+    def __init__(self, app, sock, stubs, options):
+        self.app = app
+        self.socket = sock
+        self.stubs = stubs
+        self.options = options
+        self.server = None
+
+    def _handle_stop(self, signum, frame):
+        # shutdown blocks until serve_forever returns, so call it elsewhere
+        threading.Thread(target=self.server.shutdown).start()
+
+    def run(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.stubs.activate()
+        self.server = PooledWSGIServer(self.options.host, self.options.port, self.app,
+            threads=self.options.threads, fd=self.socket.fileno())
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        logging.info('Worker %s started', os.getpid())
+        try:
+            # closes the server (and waits on in-flight requests) once shut down
+            self.server.serve_forever()
+        finally:
+            self.stubs.deactivate()
+        logging.info('Worker %s stopped', os.getpid())
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='run.py serve',
+        description='Serve the app with multiple preforked worker processes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None,
+        help='number of worker processes, defaults to number of cores with '
+        '--api-server and 1 otherwise')
+    parser.add_argument('--threads', type=int, default=8,
+        help='number of threads per worker')
+    parser.add_argument('--backlog', type=int, default=128)
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+        help='seconds workers get to finish in-flight requests when stopping')
+    parser.add_argument('--api-server', default=None,
+        help='host:port of a dev_appserver.py API server to use instead of local stubs')
+    parser.add_argument('--datastore-path', default='.datastore.sqlite3',
+        help='sqlite file the datastore is kept in when using local stubs')
+    options = parser.parse_args(argv)
+    if options.workers is None:
+        options.workers = multiprocessing.cpu_count() if options.api_server else 1
+    elif options.workers > 1 and not options.api_server:
+        # each worker would have its own memcache, and its own transactions
+        parser.error('--workers above 1 requires --api-server, local stubs are per process')
+    return options
+
+
+def serve(create_app, argv):
+    """Serve the application returned by create_app.
+
+    @param create_app function that builds the WSGI application
+    @param argv command line arguments
+    """
+    logging.basicConfig(format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
+    logging.getLogger().setLevel(logging.INFO)
+    Master(create_app, parse_args(argv)).run()
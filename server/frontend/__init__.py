@@ -1,7 +1,18 @@
 from .. import create_app as factory_create_app
+from ..assets import asset_manifest
 
 def create_app(settings_override=None):
    """Creates API specific application instance.
    """
    app = factory_create_app(__name__, __path__, settings_override)
+   init_assets(app)
    return app
+
+
+def init_assets(app):
+   """Loads the client asset manifest and makes asset urls available to templates.
+   """
+   if 'ASSETS' not in app.config:
+      raise RuntimeError('{} configuration missing!'.format('ASSETS'))
+   asset_manifest.init_config(app.config['ASSETS'])
+   app.jinja_env.globals['asset_url'] = asset_manifest.url_for
@@ -0,0 +1,86 @@
+from flask import Blueprint, request, abort
+from ..profiler import request_profiler
+from ..retention import retention
+from ..budgets import latency_budgets
+from ..cache import model_cache
+from ..migrations import migration_runner, MigrationException
+from ..serializers import respond
+
+bp = Blueprint('admin', __name__, url_prefix='/_admin')
+
+
+@bp.route('/profiles')
+def profiles_report():
+    """Report the top hotspots per route, merged from stored profiles. Takes
+    optional 'route', 'limit' and 'sort' (tottime, cumtime or calls) arguments.
+    """
+    return respond(request_profiler.report(
+        route=request.args.get('route'),
+        limit=request.args.get('limit', 20, type=int),
+        sort=request.args.get('sort', 'tottime')))
+
+
+@bp.route('/profiles/token')
+def profiles_token():
+    """Issue a token for profiling requests on demand.
+    """
+    return respond(dict(header=request_profiler.header, token=request_profiler.make_token(),
+        max_age=request_profiler.token_max_age))
+
+
+@bp.route('/retention')
+def retention_report():
+    """Report the latest retention run per kind, with entities scanned and
+    deleted and how fast.
+    """
+    return respond(retention.report())
+
+
+@bp.route('/retention/start', methods=['GET', 'POST'])
+def retention_start():
+    """Start (or resume) retention runs, for the kinds given by the optional
+    'kind' arguments or all of them. Allows GET for cron, see cron.yaml.
+    """
+    try:
+        return respond(retention.start(request.args.getlist('kind') or None))
+    except ValueError as e:
+        abort(400, str(e))
+
+
+@bp.route('/migrations')
+def migrations_report():
+    """Report the registered migrations, with the progress and throughput of
+    each shard of their latest run and dry run.
+    """
+    return respond(migration_runner.report())
+
+
+@bp.route('/migrations/<int:version>/start', methods=['POST'])
+def migrations_start(version):
+    """Start (or resume) the migration with given version. Takes optional
+    'dry_run' and 'shards' arguments.
+    """
+    if version not in migration_runner.migrations:
+        abort(404)
+    try:
+        return respond(dict(status=migration_runner.start(version,
+            dry_run=request.args.get('dry_run', '').lower() in ('1', 'true'),
+            shards=request.args.get('shards', type=int))))
+    except MigrationException as e:
+        abort(409, str(e))
+
+
+@bp.route('/cache')
+def cache_report():
+    """Report lookups and hit rates per model with a cache policy, along with
+    the global memcache statistics.
+    """
+    return respond(model_cache.get_stats())
+
+
+@bp.route('/budgets')
+def budgets_report():
+    """Report requests, overruns, backend timeouts and fallbacks per latency
+    budget.
+    """
+    return respond(latency_budgets.get_stats())
@@ -1,12 +1,22 @@
 import os
 
-from flask import Blueprint, render_template, current_app, redirect, session, request
-from .. import security
+from flask import Blueprint, render_template, current_app, redirect, session, request, make_response
+from .. import security, ratelimit, budgets
 from ..models import User
 
 bp = Blueprint('home', __name__)
 
 
+@bp.route('/')
+@bp.route('/index.html')
+def index():
+    """Serve the HTML shell of the client app. Assets it references are
+    fingerprinted and cached for good, the shell itself is always revalidated.
+    """
+    resp = make_response(render_template('index.html'))
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
 @bp.route('/signout')
 def signout():
     """Invalidate user session, and redirect them to homepage."""
@@ -14,12 +24,16 @@ def signout():
     return redirect('/')
 
 @bp.route('/signin/<provider_id>')
+@ratelimit.limit('SIGNIN')
 @security.start_oauth_signin
 def signin(provider_id):
     pass
 
 @bp.route('/signin/<provider_id>/complete')
+@ratelimit.limit('SIGNIN')
+@budgets.budget('SIGNIN')
 @security.end_oauth_signin
 def signin_complete(provider_id, oauth_info):
     user = User.get_or_create_by_oauth_info(oauth_info)
-    pass
+    # signed in, see security.auth_required (and per user rate limits)
+    session['user'] = user.get_key()
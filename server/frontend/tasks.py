@@ -0,0 +1,19 @@
+import logging
+
+from flask import Blueprint, request
+from .. import tasks
+
+bp = Blueprint('tasks', __name__, url_prefix=tasks.constants.TASKS_URL_PREFIX)
+
+
+@bp.route('/<name>', methods=['post'])
+@tasks.queue_only
+def run_task(name):
+    """Runs a task pushed to us by the task queue. Failing with an error status
+    tells the queue to retry, permanent failures are acknowledged and dropped.
+    """
+    try:
+        tasks.task_runner.run(tasks.Task.from_payload(name, request.get_data()))
+    except tasks.PermanentTaskFailure as e:
+        logging.error('Task %s failed permanently: %s', name, e)
+    return '', 200
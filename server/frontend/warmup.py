@@ -0,0 +1,13 @@
+from flask import Blueprint
+from ..serializers import respond
+from .. import warmup
+
+bp = Blueprint('warmup', __name__)
+
+
+@bp.route('/_ah/warmup')
+def warmup_instance():
+    """Handles App Engine warmup requests, sent before an instance gets
+    any user traffic (see inbound_services in app.yaml).
+    """
+    return respond(warmup.warmup())
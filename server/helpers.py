@@ -1,4 +1,8 @@
-from flask import json, request
+import zlib
+
+from datetime import date, datetime
+from flask import json, request, current_app
+from werkzeug.http import http_date
 
 MIME_TYPE_APPLICATION_JSON = 'application/json'
 MIME_TYPE_TEXT_HTML = 'text/html'
@@ -14,12 +18,117 @@ def use_json_mimetype():
     return (target == MIME_TYPE_APPLICATION_JSON and \
         request.accept_mimetypes[target] > request.accept_mimetypes[MIME_TYPE_TEXT_HTML])
 
-class JSONSerializable(object):
-    def to_json(self):
+class Serializable(object):
+    """Objects that turn themselves into plain structures (dicts, lists,
+    strings, numbers), which any serializer can emit.
+    """
+    def to_plain(self):
         pass
 
+    def to_json(self):
+        return self.to_plain()
+
+# the protocol used to be JSON only
+JSONSerializable = Serializable
+
 class JSONSerializableEncoder(json.JSONEncoder):
     def default(self, obj): # pylint: disable=E0202
-        if isinstance(obj, JSONSerializable):
-            return obj.to_json()
-        return super(JSONSerializableEncoder, self).default(obj)
\ No newline at end of file
+        if isinstance(obj, Serializable):
+            return obj.to_plain()
+        return super(JSONSerializableEncoder, self).default(obj)
+
+
+def to_plain(obj):
+    """Recursively convert given object into plain structures. Dates are
+    formatted the same way Flask's JSON encoder does.
+
+    @param obj Serializable, or structure containing Serializable objects
+    """
+    if isinstance(obj, Serializable):
+        obj = obj.to_plain()
+    if isinstance(obj, dict):
+        return dict((k, to_plain(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [to_plain(v) for v in obj]
+    if isinstance(obj, datetime):
+        return http_date(obj.utctimetuple())
+    if isinstance(obj, date):
+        return http_date(obj.timetuple())
+    return obj
+
+
+def iter_json(items, chunk_size=8192, encoder=None):
+    """Incrementally encode given list of items as a JSON array, returning a
+    generator of roughly chunk_size chunks so the whole document is never
+    built in memory.
+
+    @param items iterable of Serializable (or JSON encodable) items
+    @param chunk_size approximate size of yielded chunks
+    @param encoder optional JSONEncoder instance, defaults to the app's
+    """
+    # grab the encoder now, the generator may run after the app context is gone
+    encoder = encoder or current_app.json_encoder()
+
+    def generate():
+        buf = ['[']
+        size = 1
+        for i, item in enumerate(items):
+            if i > 0:
+                buf.append(',')
+            encoded = encoder.encode(item)
+            buf.append(encoded)
+            size += len(encoded) + 1
+            if size >= chunk_size:
+                yield ''.join(buf)
+                buf, size = [], 0
+        buf.append(']\n')
+        yield ''.join(buf)
+    return generate()
+
+
+def _gzip_iter(chunks, level):
+    """Gzip given chunks as they're produced.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gzip_response(response, min_size=1024, level=6, mimetypes=None):
+    """Gzip given response if the client accepts it and it's worth compressing.
+    Streamed responses are compressed as they're produced, their size isn't
+    known upfront so they're always compressed. Strong ETags of compressed
+    responses are made weak.
+
+    @param response the response to compress
+    @param min_size responses smaller than this (in bytes) are left alone
+    @param level zlib compression level
+    @param mimetypes list of mimetypes to compress, defaults to all
+    """
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip'] \
+      or response.status_code < 200 or response.status_code in (204, 206, 304) \
+      or response.direct_passthrough \
+      or 'Content-Encoding' in response.headers \
+      or (mimetypes is not None and response.mimetype not in mimetypes):
+        return response
+
+    if response.is_streamed:
+        response.response = _gzip_iter(response.response, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(''.join(_gzip_iter([data], level)))
+    response.headers['Content-Encoding'] = 'gzip'
+    # the bytes differ from the identity response, only the content is the same
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,202 @@
+"""
+    server.idempotency
+
+Lets clients safely retry writes by sending an Idempotency-Key header. The
+first response for a key is stored in memcache, and in the datastore should
+memcache lose it, and replayed for later requests with the same key. While
+the first request is in flight, duplicates wait for its response and give
+up with a 409 if it takes too long, or the request's latency budget runs
+out.
+"""
+import datetime
+import hashlib
+import logging
+import time
+
+from functools import wraps
+from flask import request, session, current_app
+from google.appengine.api import memcache
+from .budgets import latency_budgets
+from .models import IdempotentResponse
+from .serializers import respond
+
+K_ENABLED = 'ENABLED'
+K_HEADER = 'HEADER'
+K_TTL = 'TTL'
+K_LOCK_TIMEOUT = 'LOCK_TIMEOUT'
+K_WAIT = 'WAIT'
+K_MAX_KEY_LENGTH = 'MAX_KEY_LENGTH'
+
+H_REPLAYED = 'Idempotent-Replayed'
+# not replayed, they're specific to the original response
+SKIPPED_HEADERS = set(['content-length', 'date', 'set-cookie'])
+
+
+class IdempotencyStore(object):
+    """Stores the responses to requests carrying an idempotency key, and keeps
+    track of the ones in flight.
+    """
+    RESPONSE_PREFIX = 'idempotency:'
+    LOCK_PREFIX = 'idempotency-lock:'
+    POLL_INTERVAL = 0.1
+
+    def __init__(self):
+        self.enabled = False
+        self.header = 'Idempotency-Key'
+        self.ttl = 86400
+        self.lock_timeout = 60
+        self.wait = 5
+        self.max_key_length = 255
+
+    def init_config(self, config):
+        """Initialize with given settings.
+
+        @param config IDEMPOTENCY settings
+        """
+        self.enabled = config.get(K_ENABLED, False)
+        self.header = config.get(K_HEADER, self.header)
+        self.ttl = config.get(K_TTL, self.ttl)
+        self.lock_timeout = config.get(K_LOCK_TIMEOUT, self.lock_timeout)
+        self.wait = config.get(K_WAIT, self.wait)
+        self.max_key_length = config.get(K_MAX_KEY_LENGTH, self.max_key_length)
+
+    def identify(self, key):
+        """Returns the id responses to the current request are stored under,
+        keys are scoped to the route and the user (or ip) sending them.
+
+        @param key the idempotency key sent by the client
+        """
+        ident = session['user'] if 'user' in session else request.remote_addr
+        return hashlib.sha1('\n'.join(
+            [request.endpoint or '', str(ident), key]).encode('utf-8')).hexdigest()
+
+    def fingerprint(self):
+        """Returns a digest of the current request, a key reused for a
+        different request is an error on the client's part.
+        """
+        digest = hashlib.sha1('{} {}\n'.format(request.method, request.full_path).encode('utf-8'))
+        digest.update(request.get_data())
+        return digest.hexdigest()
+
+    def get(self, id, use_datastore=True):
+        """Returns the stored response with given id, or None.
+
+        @param id see IdempotencyStore.identify
+        @param use_datastore fall back to the datastore on a memcache miss
+        """
+        stored = memcache.get(self.RESPONSE_PREFIX + id)
+        if stored is not None or not use_datastore:
+            return stored
+        entity = IdempotentResponse.get_by_id(id)
+        if entity is None or entity.expires_at < datetime.datetime.utcnow():
+            return None
+        stored = entity.to_stored()
+        try:
+            memcache.set(self.RESPONSE_PREFIX + id, stored,
+                time=max(1, int((entity.expires_at - datetime.datetime.utcnow()).total_seconds())))
+        except ValueError:
+            # too large for memcache, see IdempotencyStore.put
+            pass
+        return stored
+
+    def put(self, id, fingerprint, resp):
+        """Store given response under given id for TTL seconds.
+
+        @param id see IdempotencyStore.identify
+        @param fingerprint see IdempotencyStore.fingerprint
+        @param resp the response to store
+        """
+        stored = dict(fingerprint=fingerprint, status=resp.status_code, body=resp.get_data(),
+            headers=[(k, v) for k, v in resp.headers if k.lower() not in SKIPPED_HEADERS])
+        future = IdempotentResponse(id=id,
+            expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl),
+            **stored).put_async()
+        try:
+            memcache.set(self.RESPONSE_PREFIX + id, stored, time=self.ttl)
+        except ValueError as e:
+            # too large for memcache, replayed from the datastore instead
+            logging.info('Unable to cache response %s: %s', id, e)
+        future.get_result()
+
+    def acquire(self, id):
+        """Mark the request with given id as in flight, returns False if it
+        already is, or memcache is unavailable (see IdempotencyStore.in_flight).
+        """
+        return memcache.add(self.LOCK_PREFIX + id, True, time=self.lock_timeout)
+
+    def in_flight(self, id):
+        """Returns whether the request with given id is in flight.
+        """
+        return memcache.get(self.LOCK_PREFIX + id) is not None
+
+    def release(self, id):
+        memcache.delete(self.LOCK_PREFIX + id)
+
+
+idempotency_store = IdempotencyStore()
+
+
+def _replay(stored, fingerprint):
+    if stored['fingerprint'] != fingerprint:
+        return respond(dict(message='Idempotency key was used for a different request'),
+            status=422)
+    resp = current_app.response_class(stored['body'], status=stored['status'],
+        headers=stored['headers'])
+    resp.headers[H_REPLAYED] = 'true'
+    return resp
+
+
+def idempotent(fn):
+    """Decorates a write route so requests with an idempotency key run at
+    most once per key, retries get the response of the first request.
+    Error responses (5xx) aren't stored, so those can be retried.
+
+    @param fn function to decorate
+    """
+    @wraps(fn)
+    def decorator(*args, **kwargs):
+        key = request.headers.get(idempotency_store.header)
+        if not idempotency_store.enabled or not key:
+            return fn(*args, **kwargs)
+        if len(key) > idempotency_store.max_key_length:
+            return respond(dict(message='Idempotency key is too long'), status=400)
+
+        id = idempotency_store.identify(key)
+        fingerprint = idempotency_store.fingerprint()
+        # within a latency budget, don't wait for longer than what's left of it
+        remaining = latency_budgets.deadline()
+        wait = idempotency_store.wait if remaining is None else min(remaining, idempotency_store.wait)
+        deadline = time.time() + wait
+        stored = idempotency_store.get(id)
+        acquired = stored is None and idempotency_store.acquire(id)
+        # add also fails if memcache is unavailable, only wait on an actual lock
+        while stored is None and not acquired and idempotency_store.in_flight(id):
+            if time.time() >= deadline:
+                resp = respond(dict(message='A request with this idempotency key is in progress'),
+                    status=409)
+                resp.headers['Retry-After'] = str(idempotency_store.wait)
+                return resp
+            time.sleep(idempotency_store.POLL_INTERVAL)
+            # the in flight request stores its response in memcache first
+            stored = idempotency_store.get(id, use_datastore=False)
+            if stored is None:
+                acquired = idempotency_store.acquire(id)
+        if stored is not None:
+            return _replay(stored, fingerprint)
+        if not acquired:
+            logging.warn('Unable to lock idempotency key %s, running unlocked', id)
+
+        try:
+            # the first request may have finished between our lookup and the
+            # lock, its response only made it to the datastore if too large
+            stored = idempotency_store.get(id)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+            resp = current_app.make_response(fn(*args, **kwargs))
+            if resp.status_code < 500:
+                idempotency_store.put(id, fingerprint, resp)
+            return resp
+        finally:
+            if acquired:
+                idempotency_store.release(id)
+    return decorator
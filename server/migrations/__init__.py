@@ -0,0 +1,48 @@
+"""
+    server.migrations
+"""
+from core import MigrationRunner, MigrationException, split_key_range
+from .. import tasks
+from . import constants
+
+
+migration_runner = MigrationRunner()
+
+
+def migration(version, model_class):
+    """Registers decorated function as the migration with given version. The
+    function takes an entity of given model class, updates it in place and
+    returns True if it changed. It may see entities it already migrated, e.g.
+    when a batch is retried, so it should leave those unchanged.
+
+    @param version unique, increasing integer
+    @param model_class model class whose entities are migrated
+    """
+    def decorator(fn):
+        migration_runner.register(version, model_class, fn)
+        return fn
+    return decorator
+
+
+def _enqueue(shard):
+    run_migration_shard.defer(shard.key.id(), shard.invocations,
+        _task_name=migration_runner.chain.task_name(shard))
+
+
+def init_config(config):
+    """Initialize the migration runner with given settings.
+
+    @param config MIGRATIONS settings
+    """
+    migration_runner.init_config(config, _enqueue)
+
+
+@tasks.task('migrations.run_shard')
+def run_migration_shard(shard_id, invocation):
+    """Task processing the next batches of given migration shard.
+    """
+    migration_runner.step(shard_id, invocation)
+
+
+# registers our migrations
+from . import versions
@@ -0,0 +1,8 @@
+K_BATCH_SIZE = 'BATCH_SIZE'
+K_TIME_LIMIT = 'TIME_LIMIT'
+K_SHARDS = 'SHARDS'
+
+# scattered keys sampled per shard when splitting a kind into key ranges
+OVERSAMPLING = 32
+# max keys scanned to split kinds too small to have enough scattered keys
+SCAN_LIMIT = 10000
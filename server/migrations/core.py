@@ -0,0 +1,216 @@
+import datetime
+import logging
+import time
+
+from google.appengine.datastore import datastore_query
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from ..cache import model_cache
+from ..models import Migration, MigrationShard
+from .. import tasks
+from . import constants
+
+
+class MigrationException(Exception):
+    """Generic migration related exception.
+    """
+    pass
+
+
+def split_key_range(model_class, shards):
+    """Returns up to shards - 1 keys splitting the entities of given model
+    class into ranges of roughly the same size. Split points are picked from
+    a sample ordered by the datastore's __scatter__ property, small kinds
+    (with too few scattered entities) are sampled by scanning their keys.
+
+    @param model_class the model class to split
+    @param shards number of ranges wanted
+    """
+    if shards < 2:
+        return []
+    sample = model_class.query().order(datastore_query.PropertyOrder('__scatter__')).fetch(
+        shards * constants.OVERSAMPLING, keys_only=True)
+    if len(sample) < shards * constants.OVERSAMPLING:
+        sample = model_class.query().fetch(constants.SCAN_LIMIT, keys_only=True)
+    sample = sorted(sample)
+    splits = []
+    for i in range(1, shards):
+        key = sample[len(sample) * i // shards] if sample else None
+        if key is not None and key not in splits:
+            splits.append(key)
+    return splits
+
+
+class MigrationRunner(object):
+    """Registry of versioned migrations, and entry point for running them.
+    Each migration runs over key range shards in parallel, each shard being
+    processed by a chain of tasks working through batches until their time
+    limit and checkpointing after every batch.
+    """
+    def __init__(self):
+        self.migrations = {}
+        self.config = {}
+        self.batch_size = 200
+        self.time_limit = 60
+        self.shards = 4
+        self.enqueue = None
+        self.chain = tasks.TaskChain('migration', MigrationShard)
+
+    def init_config(self, config, enqueue):
+        """Initialize runner with given settings.
+
+        @param config MIGRATIONS settings
+        @param enqueue function deferring a shard step, see server.migrations
+        """
+        self.config = dict(config)
+        self.batch_size = config.get(constants.K_BATCH_SIZE, self.batch_size)
+        self.time_limit = config.get(constants.K_TIME_LIMIT, self.time_limit)
+        self.shards = config.get(constants.K_SHARDS, self.shards)
+        self.enqueue = enqueue
+
+    def register(self, version, model_class, fn, name=None):
+        """Registers a migration function for given version.
+
+        @param version unique, increasing integer
+        @param model_class model class whose entities are migrated
+        @param fn function taking an entity, updating it in place and
+                  returning True if it changed (and should be saved)
+        @param name optional name, defaults to the function name
+        """
+        if version in self.migrations:
+            raise MigrationException('Migration {} already registered!'.format(version))
+        self.migrations[version] = (name or fn.__name__, model_class, fn)
+
+    def _get_migration(self, version):
+        if version not in self.migrations:
+            raise MigrationException('Migration {} not found!'.format(version))
+        return self.migrations[version]
+
+    def start(self, version, dry_run=False, shards=None):
+        """Start the migration with given version, or resume it if it stopped
+        making progress. A migration is only ever applied once, dry runs only
+        report what it would change and can be repeated.
+
+        @param version version of a registered migration
+        @param dry_run run the migration without saving anything
+        @param shards optional number of shards, defaults to settings
+        @returns 'started', 'resumed' or 'running'
+        """
+        name, model_class, _ = self._get_migration(version)
+        id = Migration.make_id(version, dry_run)
+        now = datetime.datetime.utcnow()
+        existing = Migration.get_by_id(id)
+        splits = None
+        if existing is None or (dry_run and existing.finished_at is not None):
+            # shards are computed up front, no queries in transactions
+            splits = split_key_range(model_class, shards or self.shards)
+
+        def txn():
+            migration = Migration.get_by_id(id)
+            if migration is not None:
+                if migration.finished_at is not None and not dry_run:
+                    raise MigrationException('Migration {} was already applied'.format(version))
+                if migration.finished_at is None or splits is None:
+                    # in progress, or a dry run that finished since we looked
+                    return migration, False
+            migration = Migration(id=id, version=version, name=name, kind=model_class._get_kind(),
+                dry_run=dry_run, splits=splits, shards=len(splits) + 1, started_at=now)
+            migration.put()
+            return migration, True
+        migration, created = ndb.transaction(txn)
+        if created and existing is not None:
+            # shards of the previous dry run
+            ndb.delete_multi([s.key for s in existing.get_shards() if s is not None])
+
+        bounds = [None] + migration.splits + [None]
+        to_run, missing = [], []
+        for i, shard in enumerate(migration.get_shards()):
+            if shard is None:
+                # not created yet, or whoever started the run didn't get to it
+                missing.append(MigrationShard(id=MigrationShard.make_id(id, migration.started_at, i),
+                    migration=id, index=i, start_key=bounds[i], end_key=bounds[i + 1],
+                    started_at=migration.started_at))
+            elif shard.finished_at is None and self.chain.stalled(shard, self.time_limit):
+                self.chain.resume(shard)
+                to_run.append(shard)
+        ndb.put_multi(to_run + missing)
+        to_run.extend(missing)
+        for shard in to_run:
+            self.enqueue(shard)
+        if created:
+            return 'started'
+        return 'resumed' if to_run else 'running'
+
+    def step(self, shard_id, invocation):
+        """Process batches of given shard until done or out of time, then hand
+        over to the next invocation.
+
+        @param shard_id id of the MigrationShard
+        @param invocation number of invocations of the shard so far
+        """
+        with self.chain.claimed(shard_id, invocation, self.time_limit) as shard:
+            if shard is None:
+                logging.info('Skipping migration shard %s, invocation %s is stale',
+                    shard_id, invocation)
+                return
+            migration = Migration.get_by_id(shard.migration)
+            _, model_class, fn = self._get_migration(migration.version)
+            deadline = time.time() + self.time_limit
+            while shard.finished_at is None:
+                self._process_batch(model_class, fn, migration.dry_run, shard)
+                if time.time() >= deadline:
+                    break
+
+        if shard.finished_at is None:
+            self.chain.hand_over(shard)
+            self.enqueue(shard)
+            return
+        shard.put()
+        logging.info('Migration shard %s done, changed %s of %s entities in %.1fs (%.1f/s)%s',
+            shard_id, shard.changed, shard.processed, shard.elapsed,
+            shard.processed / shard.elapsed if shard.elapsed else 0,
+            ' (dry run)' if migration.dry_run else '')
+        shards = migration.get_shards()
+        if all(s is not None and s.finished_at is not None for s in shards):
+            migration.finished_at = datetime.datetime.utcnow()
+            migration.put()
+            logging.info('Migration %s done', migration.key.id())
+
+    def _process_batch(self, model_class, fn, dry_run, shard):
+        start = time.time()
+        query = model_class.query()
+        if shard.start_key is not None:
+            query = query.filter(model_class.key >= shard.start_key)
+        if shard.end_key is not None:
+            query = query.filter(model_class.key < shard.end_key)
+        cursor = Cursor(urlsafe=shard.cursor) if shard.cursor else None
+        # keep (possibly dry run) changes out of the context cache
+        entities, next_cursor, more = query.fetch_page(self.batch_size, start_cursor=cursor,
+            use_cache=False)
+        changed = [e for e in entities if fn(e)]
+        if changed and not dry_run:
+            with model_cache.batch_generations():
+                ndb.put_multi(changed)
+        shard.processed += len(entities)
+        shard.changed += len(changed)
+        if more and next_cursor:
+            shard.cursor = next_cursor.urlsafe()
+        else:
+            shard.cursor = None
+            shard.finished_at = datetime.datetime.utcnow()
+        shard.elapsed += time.time() - start
+        shard.put()
+
+    def report(self):
+        """Returns the registered migrations along with their latest run and
+        dry run, including the progress and throughput of each shard.
+        """
+        rv = []
+        for version in sorted(self.migrations):
+            name, model_class, _ = self.migrations[version]
+            runs = ndb.get_multi([ndb.Key(Migration, Migration.make_id(version, dry_run))
+                for dry_run in (False, True)])
+            rv.append(dict(version=version, name=name, kind=model_class._get_kind(),
+                run=runs[0], dry_run=runs[1],
+                shards=[s for run in runs if run is not None for s in run.get_shards() if s]))
+        return rv
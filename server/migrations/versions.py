@@ -0,0 +1,27 @@
+"""
+    server.migrations.versions
+
+Migrations, in order of version. Start them (dry run first) from
+/_admin/migrations.
+"""
+from ..models import User, OAuth
+from . import migration
+
+
+@migration(1, User)
+def normalize_user_email(user):
+    """Backfill User.email_normalized, set on new users since it was added.
+    """
+    normalized = User.normalize_email(user.email)
+    if user.email_normalized == normalized:
+        return False
+    user.email_normalized = normalized
+    return True
+
+
+@migration(2, OAuth)
+def backfill_oauth_updated_at(oauth):
+    """Backfill OAuth.updated_at (auto_now) on tokens saved before it was
+    added, which retention could otherwise never consider stale.
+    """
+    return oauth.updated_at is None
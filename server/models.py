@@ -3,10 +3,13 @@ import logging
 from collections import namedtuple
 from google.appengine.ext import ndb
 from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
-from .helpers import JSONSerializable
+from .helpers import Serializable
+from .cache import model_cache
+from .budgets import latency_budgets
+from . import tasks
 
 
-class AbstractModel(JSONSerializable, ndb.Model):
+class AbstractModel(Serializable, ndb.Model):
     @classmethod
     def to_key(urlsafe_key):
         """Helper for converting urlsafe key to model key.
@@ -68,7 +71,9 @@ class AbstractModel(JSONSerializable, ndb.Model):
         @param limit optional fetch limit, defaults to 50
         """
         query = cls.query() if parent_key is None else cls.query(ancestor=ndb.Key(urlsafe=parent_key))
-        return query.fetch(limit)
+        return model_cache.query(cls._get_kind(), 'list:{}:{}'.format(parent_key, limit),
+            lambda: query.fetch(limit, **latency_budgets.datastore_options()),
+            deadline=latency_budgets.deadline())
 
     @classmethod
     def count(cls, parent_key=None):
@@ -76,7 +81,8 @@ class AbstractModel(JSONSerializable, ndb.Model):
 
         @param parent_key optional ancestor key to filter by
         """
-        return cls.query().count() if parent_key is None else cls.query(ancestor=ndb.Key(urlsafe=parent_key))
+        query = cls.query() if parent_key is None else cls.query(ancestor=ndb.Key(urlsafe=parent_key))
+        return query.count(**latency_budgets.datastore_options())
 
     @classmethod
     def get_by_key(cls, key):
@@ -87,7 +93,7 @@ class AbstractModel(JSONSerializable, ndb.Model):
         @param key identifying key
         """
         try:
-            return ndb.Key(urlsafe=key).get()
+            return model_cache.get(ndb.Key(urlsafe=key), **latency_budgets.datastore_options())
         except ProtocolBufferDecodeError:
             return None
 
@@ -98,7 +104,7 @@ class AbstractModel(JSONSerializable, ndb.Model):
         @param id identifier
         """
         try:
-            return ndb.Key(cls, id).get()
+            return model_cache.get(ndb.Key(cls, id), **latency_budgets.datastore_options())
         except ProtocolBufferDecodeError:
             return None
 
@@ -116,15 +122,35 @@ class AbstractModel(JSONSerializable, ndb.Model):
     def save(self):
         """Save this instance to datastore.
         """
-        self.put()
+        self.put(**latency_budgets.datastore_options())
         return self
 
+    def _post_put_hook(self, future):
+        """Forget any cached miss for this instance once it's saved.
+        """
+        model_cache.forget_miss(self.key)
+        model_cache.bump_generation(self.key.kind())
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        model_cache.bump_generation(key.kind())
+
     def delete(self):
         """Delete this instance from datastore.
         """
-        self.key.delete()
+        self.key.delete(**latency_budgets.datastore_options())
 
-    def to_json(self):
+    @classmethod
+    def subclasses(cls):
+        """Returns all model classes extending implementing class.
+        """
+        rv = []
+        for sub in cls.__subclasses__():
+            rv.append(sub)
+            rv.extend(sub.subclasses())
+        return rv
+
+    def to_plain(self):
         rv = self.to_dict()
         rv['key'] = self.key.urlsafe()
         return rv
@@ -133,6 +159,137 @@ class AbstractModel(JSONSerializable, ndb.Model):
 class Setting(AbstractModel):
     value = ndb.StringProperty()
 
+class Profile(AbstractModel):
+    """Class representing a profiled request, see server.profiler.
+    """
+    route = ndb.StringProperty(indexed=True, required=True)
+    # seconds the request took
+    duration = ndb.FloatProperty(indexed=False)
+    # marshalled dict of function to (primitive calls, calls, tottime, cumtime)
+    stats = ndb.BlobProperty(compressed=True)
+    created_at = ndb.DateTimeProperty(auto_now=True)
+
+    def to_plain(self):
+        rv = super(Profile, self).to_plain()
+        rv.pop('stats', None)
+        return rv
+
+class RetentionRun(AbstractModel):
+    """Class representing the progress of a retention run over a kind (the
+    id), checkpointed after every batch, see server.retention.
+    """
+    # index of the policy being applied, and where its query left off
+    policy = ndb.IntegerProperty(default=0, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    invocations = ndb.IntegerProperty(default=0, indexed=False)
+    # when a task took the current invocation, None once it handed over
+    claimed_at = ndb.DateTimeProperty(indexed=False)
+    scanned = ndb.IntegerProperty(default=0, indexed=False)
+    deleted = ndb.IntegerProperty(default=0, indexed=False)
+    cleared = ndb.IntegerProperty(default=0, indexed=False)
+    # seconds spent processing batches, over all invocations
+    elapsed = ndb.FloatProperty(default=0.0, indexed=False)
+    started_at = ndb.DateTimeProperty()
+    finished_at = ndb.DateTimeProperty()
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+    def to_plain(self):
+        rv = super(RetentionRun, self).to_plain()
+        rv.pop('cursor', None)
+        rv['scanned_per_second'] = self.scanned / self.elapsed if self.elapsed else None
+        rv['deleted_per_second'] = self.deleted / self.elapsed if self.elapsed else None
+        rv['cleared_per_second'] = self.cleared / self.elapsed if self.elapsed else None
+        return rv
+
+class Migration(AbstractModel):
+    """Class representing a run (or dry run) of a versioned migration, see
+    server.migrations.
+    """
+    version = ndb.IntegerProperty(required=True)
+    name = ndb.StringProperty(indexed=False)
+    kind = ndb.StringProperty(indexed=False)
+    dry_run = ndb.BooleanProperty(default=False, indexed=False)
+    # keys splitting the kind into key range shards
+    splits = ndb.KeyProperty(repeated=True, indexed=False)
+    shards = ndb.IntegerProperty(default=1, indexed=False)
+    started_at = ndb.DateTimeProperty()
+    finished_at = ndb.DateTimeProperty()
+
+    @staticmethod
+    def make_id(version, dry_run=False):
+        return '{}-dry-run'.format(version) if dry_run else str(version)
+
+    def get_shards(self):
+        """Returns the shards of this run, None for those not created yet.
+        """
+        return ndb.get_multi([ndb.Key(MigrationShard,
+            MigrationShard.make_id(self.key.id(), self.started_at, i)) for i in range(self.shards)])
+
+    def to_plain(self):
+        rv = super(Migration, self).to_plain()
+        rv.pop('splits', None)
+        return rv
+
+class MigrationShard(AbstractModel):
+    """Class representing the progress of a migration over a key range,
+    checkpointed after every batch, see server.migrations.
+    """
+    # id of the Migration
+    migration = ndb.StringProperty(required=True)
+    index = ndb.IntegerProperty(indexed=False)
+    # key range covered, None for unbounded
+    start_key = ndb.KeyProperty(indexed=False)
+    end_key = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    invocations = ndb.IntegerProperty(default=0, indexed=False)
+    # when a task took the current invocation, None once it handed over
+    claimed_at = ndb.DateTimeProperty(indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    changed = ndb.IntegerProperty(default=0, indexed=False)
+    # seconds spent processing batches, over all invocations
+    elapsed = ndb.FloatProperty(default=0.0, indexed=False)
+    started_at = ndb.DateTimeProperty()
+    finished_at = ndb.DateTimeProperty()
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def make_id(migration_id, started_at, index):
+        # dry runs may be repeated, each run gets its own shards
+        return '{}-{}-{}'.format(migration_id, started_at.strftime('%Y%m%d%H%M%S%f'), index)
+
+    def to_plain(self):
+        rv = super(MigrationShard, self).to_plain()
+        rv.pop('cursor', None)
+        for k in ('start_key', 'end_key'):
+            rv[k] = rv[k].urlsafe() if rv[k] else None
+        rv['processed_per_second'] = self.processed / self.elapsed if self.elapsed else None
+        rv['changed_per_second'] = self.changed / self.elapsed if self.elapsed else None
+        return rv
+
+class IdempotentResponse(AbstractModel):
+    """Class representing the response to a request carrying an idempotency
+    key (the id is derived from it), see server.idempotency.
+    """
+    # digest of the request the response belongs to
+    fingerprint = ndb.StringProperty(indexed=False)
+    status = ndb.IntegerProperty(indexed=False)
+    # list of (name, value) pairs
+    headers = ndb.JsonProperty()
+    body = ndb.BlobProperty(compressed=True)
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
+    expires_at = ndb.DateTimeProperty(indexed=False)
+
+    def to_stored(self):
+        """Returns the response the way it's kept in memcache.
+        """
+        return dict(fingerprint=self.fingerprint, status=self.status,
+            headers=[tuple(h) for h in self.headers], body=self.body)
+
+    def to_plain(self):
+        rv = super(IdempotentResponse, self).to_plain()
+        rv.pop('body', None)
+        return rv
+
 class OAuth(AbstractModel):
     """Class representing OAuth token, and User group (e.g. parent=User)
     """
@@ -142,7 +299,9 @@ class OAuth(AbstractModel):
     provider_id = ndb.StringProperty(indexed=True, required=True)
     # Dict of token type, refresh token, and access token
     token = ndb.JsonProperty()
-    created_at = ndb.DateTimeProperty()
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
+    # refreshed along with the token on every signin, backfilled by migration 2
+    updated_at = ndb.DateTimeProperty(auto_now=True)
 
     def update_token(self, token):
         self.token = token
@@ -155,7 +314,8 @@ class OAuth(AbstractModel):
         @param identity identifier unique to given provider
         @param provider_id id of OAuth provider
         """
-        return cls.query(cls.identity == identity, cls.provider_id == provider_id).get()
+        return cls.query(cls.identity == identity, cls.provider_id == provider_id).get(
+            **latency_budgets.datastore_options())
         
     @classmethod
     def _preprocess_new_params(cls, **kwargs):
@@ -169,21 +329,43 @@ class OAuth(AbstractModel):
 class User(AbstractModel):
     name = ndb.StringProperty()
     email = ndb.StringProperty()
+    # lower cased email for lookups, backfilled by migration 1
+    email_normalized = ndb.StringProperty()
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
+    @staticmethod
+    def normalize_email(email):
+        return email.strip().lower() if email else None
+
+    @classmethod
+    def _preprocess_new_params(cls, **kwargs):
+        kwargs['email_normalized'] = cls.normalize_email(kwargs.get('email'))
+        return super(User, cls)._preprocess_new_params(**kwargs)
+
     @classmethod
     def get_or_create_by_oauth_info(cls, oauth_info):
         oauth = OAuth.find_by_identity(oauth_info['identity'], oauth_info['provider_id'])
         if oauth is None:
             return ndb.transaction(lambda: cls._create_user_with_oauth(oauth_info))
         else:
-            ndb.transaction(oauth.update_token(oauth_info['token']))
-            return oauth.key.parent().get()
+            # refreshing the stored token isn't needed to complete signin
+            update_oauth_token.defer(oauth.get_key(), oauth_info['token'])
+            return cls.get_by_key(oauth.key.parent().urlsafe())
 
     @classmethod   
     def _create_user_with_oauth(cls, oauth_info):
-        oauth = OAuth.create(parent=cls.create().key, **oauth_info)
-        return oauth.key.parent().get()
+        user = cls.create()
+        OAuth.create(parent=user.key, **oauth_info)
+        return user
 
- 
 
+@tasks.task('oauth.update_token')
+def update_oauth_token(urlsafe_key, token):
+    """Task for updating the token of OAuth instance with given urlsafe key.
+    """
+    def txn():
+        oauth = OAuth.get_by_key(urlsafe_key)
+        if oauth is None:
+            raise tasks.PermanentTaskFailure('OAuth {} not found'.format(urlsafe_key))
+        oauth.update_token(token)
+    ndb.transaction(txn)
@@ -0,0 +1,146 @@
+"""
+    server.profiler
+
+Profiles requests with cProfile, either a random sample of them or on demand
+when a request carries a signed profiling header (see Profiler.make_token).
+Profiles are kept in a capped ring of Profile entities per route, and merged
+into hotspot reports by the admin endpoint.
+"""
+import cProfile
+import logging
+import marshal
+import random
+import time
+
+from collections import defaultdict
+from flask import g, request
+from google.appengine.api import memcache
+from itsdangerous import TimestampSigner, BadSignature
+from .models import Profile
+
+K_ENABLED = 'ENABLED'
+K_SAMPLE_RATE = 'SAMPLE_RATE'
+K_RING_SIZE = 'RING_SIZE'
+K_HEADER = 'HEADER'
+K_TOKEN_MAX_AGE = 'TOKEN_MAX_AGE'
+
+SORT_KEYS = {'tottime': 2, 'cumtime': 3, 'calls': 1}
+
+
+class Profiler(object):
+    RING_PREFIX = 'profiler-ring:'
+    SIGNER_SALT = 'profiler'
+
+    def __init__(self):
+        self.config = {}
+        self.enabled = False
+        self.sample_rate = 0
+        self.ring_size = 20
+        self.header = 'X-Profile'
+        self.token_max_age = 3600
+        self.signer = None
+
+    def init_config(self, config, secret_key):
+        """Initialize profiler with given settings.
+
+        @param config PROFILER settings
+        @param secret_key key used for signing profiling tokens
+        """
+        self.config = dict(config)
+        self.enabled = config.get(K_ENABLED, False)
+        self.sample_rate = config.get(K_SAMPLE_RATE, 0)
+        self.ring_size = config.get(K_RING_SIZE, self.ring_size)
+        self.header = config.get(K_HEADER, self.header)
+        self.token_max_age = config.get(K_TOKEN_MAX_AGE, self.token_max_age)
+        self.signer = TimestampSigner(secret_key, salt=self.SIGNER_SALT)
+
+    def make_token(self):
+        """Returns a value for the profiling header, valid for TOKEN_MAX_AGE seconds.
+        """
+        return self.signer.sign('profile')
+
+    def _should_profile(self):
+        token = request.headers.get(self.header)
+        if token:
+            try:
+                self.signer.unsign(token, max_age=self.token_max_age)
+                return True
+            except BadSignature:
+                logging.info('Ignoring invalid profiling token')
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        """Start profiling the current request if it's sampled or asked for.
+        """
+        if not self.enabled or not self._should_profile():
+            return
+        profile = cProfile.Profile()
+        g.profile = (profile, time.time())
+        profile.enable()
+
+    def stop(self, exc=None):
+        """Stop profiling the current request (if profiled) and store the profile.
+        """
+        profile, started_at = g.pop('profile', (None, None))
+        if profile is None:
+            return
+        profile.disable()
+        duration = time.time() - started_at
+        route = '{} {}'.format(request.method,
+            request.url_rule.rule if request.url_rule else '<unmatched>')
+        try:
+            self.store(route, duration, profile)
+        except Exception:
+            # profiling should never break the request
+            logging.exception('Unable to store profile for %s', route)
+
+    def store(self, route, duration, profile):
+        """Store given profile in the ring of given route, replacing the oldest.
+
+        @param route identifies the profiled route
+        @param duration seconds the request took
+        @param profile the cProfile.Profile
+        """
+        profile.create_stats()
+        # callers make up most of the size and aren't needed for hotspots
+        stats = dict((func, stat[:4]) for func, stat in profile.stats.items())
+        slot = (memcache.incr(self.RING_PREFIX + route, initial_value=0) or 0) % self.ring_size
+        Profile(id='{}:{}'.format(route, slot),
+            route=route,
+            duration=duration,
+            stats=marshal.dumps(stats)).put()
+
+    def report(self, route=None, limit=20, sort='tottime'):
+        """Merge stored profiles into a report of top hotspots per route.
+
+        @param route optional route to report on, defaults to all
+        @param limit number of hotspots per route
+        @param sort one of tottime, cumtime or calls
+        """
+        sort_index = SORT_KEYS.get(sort, SORT_KEYS['tottime'])
+        query = Profile.query() if route is None else Profile.query(Profile.route == route)
+        merged = defaultdict(lambda: defaultdict(lambda: [0, 0, 0.0, 0.0]))
+        durations = defaultdict(list)
+        for p in query.iter():
+            durations[p.route].append(p.duration)
+            for func, stat in marshal.loads(p.stats).items():
+                totals = merged[p.route][func]
+                for i in range(4):
+                    totals[i] += stat[i]
+
+        report = {}
+        for _route, funcs in merged.items():
+            top = sorted(funcs.items(), key=lambda item: item[1][sort_index], reverse=True)[:limit]
+            report[_route] = dict(
+                profiles=len(durations[_route]),
+                avg_duration=sum(durations[_route]) / len(durations[_route]),
+                hotspots=[dict(
+                    function='{}:{}({})'.format(*func),
+                    calls=stat[1],
+                    primitive_calls=stat[0],
+                    tottime=stat[2],
+                    cumtime=stat[3]) for func, stat in top])
+        return report
+
+
+request_profiler = Profiler()
@@ -0,0 +1,208 @@
+"""
+    server.ratelimit
+"""
+import logging
+import math
+import threading
+import time
+
+from functools import wraps
+from flask import request, session, jsonify, current_app
+from google.appengine.api import memcache
+from . import helpers
+
+K_ENABLED = 'ENABLED'
+K_LIMITS = 'LIMITS'
+K_KEY = 'KEY'
+K_RATE = 'RATE'
+K_BURST = 'BURST'
+K_MAX_CONCURRENT = 'MAX_CONCURRENT'
+
+KEY_IP = 'ip'
+KEY_USER = 'user'
+KEY_ROUTE = 'route'
+
+
+class RateLimitException(Exception):
+    """Rate limiting related exception.
+    """
+    pass
+
+
+class TokenBucket(object):
+    """Token bucket kept in memcache, refilled at `rate` tokens per second up
+    to `burst` tokens. Updates use compare-and-set so concurrent requests
+    across instances don't lose tokens.
+    """
+    PREFIX = 'ratelimit:'
+    CAS_RETRIES = 3
+
+    def __init__(self, rate, burst):
+        """
+        @param rate tokens added per second
+        @param burst max tokens in the bucket
+        """
+        if rate <= 0 or burst < 1:
+            raise RateLimitException('Rate must be positive and burst at least 1')
+        self.rate = float(rate)
+        self.burst = burst
+        # once a bucket idles this long it's full again, no need to keep it
+        self.ttl = int(math.ceil(burst / self.rate)) + 1
+
+    def take(self, key, now=None):
+        """Take a token from bucket identified by key.
+
+        @param key identifies the bucket
+        @param now optional current time in seconds
+        @returns 0 if a token was taken, otherwise seconds until one is available
+        """
+        now = time.time() if now is None else now
+        key = self.PREFIX + key
+        # cas ids are tracked per client, so don't share one across threads
+        client = memcache.Client()
+        for _ in range(self.CAS_RETRIES):
+            bucket = client.gets(key)
+            if bucket is None:
+                if client.add(key, (self.burst - 1.0, now), time=self.ttl):
+                    return 0
+                continue
+            tokens, updated_at = bucket
+            tokens = min(self.burst, tokens + max(0, now - updated_at) * self.rate)
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            if client.cas(key, (tokens - 1, now), time=self.ttl):
+                return 0
+        # heavily contended or memcache unavailable, fail open
+        logging.warn('Unable to update rate limit bucket %s, allowing request', key)
+        return 0
+
+
+class Limit(object):
+    """A named rate limit, combining a token bucket with an optional cap on
+    concurrent in-flight requests per instance.
+    """
+    def __init__(self, name, key=KEY_IP, rate=1, burst=1, max_concurrent=0):
+        """
+        @param name name of the limit
+        @param key what requests are bucketed by: ip, user or route
+        @param rate tokens added per second
+        @param burst max tokens in the bucket
+        @param max_concurrent max in-flight requests per instance, 0 for no cap
+        """
+        if key not in (KEY_IP, KEY_USER, KEY_ROUTE):
+            raise RateLimitException('Unknown rate limit key {}'.format(key))
+        self.name = name
+        self.key = key
+        self.bucket = TokenBucket(rate, burst)
+        self.semaphore = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        # keys known to be out of tokens until given time, lets us turn
+        # away repeat offenders without a memcache round trip
+        self._denied = {}
+
+    @classmethod
+    def from_config(cls, name, config):
+        return cls(name, key=config.get(K_KEY, KEY_IP),
+            rate=config.get(K_RATE, 1),
+            burst=config.get(K_BURST, 1),
+            max_concurrent=config.get(K_MAX_CONCURRENT, 0))
+
+    def identify(self):
+        """Returns the bucket key for the current request.
+        """
+        if self.key == KEY_ROUTE:
+            ident = request.endpoint
+        elif self.key == KEY_USER and 'user' in session:
+            ident = 'user:{}'.format(session['user'])
+        else:
+            ident = request.remote_addr
+        return '{}:{}'.format(self.name, ident)
+
+    def acquire(self, now=None):
+        """Try to admit the current request.
+
+        @returns 0 if admitted, otherwise seconds the client should wait
+        """
+        now = time.time() if now is None else now
+        key = self.identify()
+        denied_until = self._denied.get(key)
+        if denied_until is not None:
+            if now < denied_until:
+                return denied_until - now
+            self._denied.pop(key, None)
+        retry_after = self.bucket.take(key, now)
+        if retry_after:
+            if len(self._denied) > 10000:
+                self._denied.clear()
+            self._denied[key] = now + retry_after
+        return retry_after
+
+
+class RateLimiter(object):
+    """Registry of configured limits.
+    """
+    def __init__(self):
+        self.config = {}
+        self.limits = {}
+        self.enabled = False
+
+    def init_config(self, config):
+        """Initialize limits from settings.
+
+        @param config RATE_LIMITS settings
+        """
+        if self.limits and self.config == config:
+            return
+        self.config = dict(config)
+        self.enabled = config.get(K_ENABLED, True)
+        self.limits = dict((name, Limit.from_config(name, c))
+            for name, c in (config.get(K_LIMITS) or {}).items())
+
+    def get_limit(self, name):
+        if name not in self.limits:
+            raise RateLimitException('Rate limit {} not found!'.format(name))
+        return self.limits[name]
+
+
+rate_limiter = RateLimiter()
+
+
+def _too_many_requests(retry_after, status_code=429):
+    """Respond with given status according to acceptable mimetypes, telling the
+    client when to retry.
+    """
+    message = 'Too Many Requests' if status_code == 429 else 'Service Unavailable'
+    if helpers.use_json_mimetype():
+        resp = jsonify({'message': message})
+    else:
+        resp = current_app.response_class(message, mimetype=helpers.MIME_TYPE_TEXT_HTML)
+    resp.status_code = status_code
+    resp.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return resp
+
+
+def limit(name):
+    """Decorates given function with the named rate limit, requests over the
+    limit are turned away with a 429, or a 503 when the instance is already
+    handling too many of them.
+
+    @param name name of a limit configured in RATE_LIMITS
+    """
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            if not rate_limiter.enabled:
+                return fn(*args, **kwargs)
+            _limit = rate_limiter.get_limit(name)
+            retry_after = _limit.acquire()
+            if retry_after:
+                return _too_many_requests(retry_after)
+            if _limit.semaphore is None:
+                return fn(*args, **kwargs)
+            if not _limit.semaphore.acquire(False):
+                return _too_many_requests(1, status_code=503)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _limit.semaphore.release()
+        return decorator
+    return wrapper
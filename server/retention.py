@@ -0,0 +1,297 @@
+"""
+    server.retention
+
+Prunes entities according to retention policies configured per model, e.g.
+OAuth tokens not refreshed in a while or entities whose parent is gone. Each
+kind is processed by a chain of tasks, every invocation running keys-only
+queries in bounded batches until its time limit, then handing over to the
+next. Progress is checkpointed in a RetentionRun after every batch, so runs
+pick up where they left off.
+"""
+import datetime
+import logging
+import time
+
+from abc import ABCMeta, abstractmethod
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from .cache import model_cache
+from .config.gae_configuration import GAEDataStoreConfiguration, PLACE_HOLDER
+from .models import RetentionRun, Setting
+from . import tasks
+
+K_MODELS = 'MODELS'
+K_BATCH_SIZE = 'BATCH_SIZE'
+K_TIME_LIMIT = 'TIME_LIMIT'
+K_MAX_AGE = 'MAX_AGE'
+K_MAX_AGE_PROPERTY = 'MAX_AGE_PROPERTY'
+K_MAX_AGE_CLEAR = 'MAX_AGE_CLEAR'
+K_ORPHANS = 'ORPHANS'
+K_PLACEHOLDERS = 'PLACEHOLDERS'
+
+
+class RetentionPolicy(object):
+    """Base class for retention policies, selecting the entities of a kind
+    that should be deleted.
+    """
+    __metaclass__ = ABCMeta
+    name = None
+
+    @abstractmethod
+    def query(self, model_class, run):
+        """Returns the query for entities that may be deleted, it's run
+        keys only.
+
+        @param model_class the model class policy applies to
+        @param run the RetentionRun in progress
+        """
+        pass
+
+    def select(self, keys):
+        """Returns which of the keys returned by the query to prune.
+
+        @param keys list of ndb.Key
+        """
+        return keys
+
+    def prune(self, model_class, keys, run):
+        """Prunes the selected entities, by deleting them.
+
+        @param model_class the model class policy applies to
+        @param keys list of ndb.Key to prune
+        @param run the RetentionRun in progress
+        """
+        # same as ndb.delete_multi minus the post delete hook, which bumps
+        # the kind's generation for every key, once per batch is enough
+        for future in [ndb.get_context().delete(k) for k in keys]:
+            future.get_result()
+        model_cache.bump_generation(model_class._get_kind())
+        run.deleted += len(keys)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, self.__dict__)
+
+
+class MaxAge(RetentionPolicy):
+    """Deletes entities whose date property is older than max age, as of
+    when the run started.
+    """
+    name = 'max_age'
+
+    def __init__(self, property_name, max_age):
+        """
+        @param property_name name of the (indexed) date property
+        @param max_age age in seconds
+        """
+        self.property_name = property_name
+        self.max_age = max_age
+
+    def cutoff(self, run):
+        return run.started_at - datetime.timedelta(seconds=self.max_age)
+
+    def query(self, model_class, run):
+        return model_class.query(model_class._properties[self.property_name] < self.cutoff(run))
+
+
+class ClearAfterMaxAge(MaxAge):
+    """Clears given properties of entities whose date property is older than
+    max age, keeping the entities themselves. The date property should be
+    updated on every write (auto_now), so cleared entities don't match again.
+    """
+    name = 'clear_after_max_age'
+
+    def __init__(self, property_name, max_age, clear):
+        """
+        @param property_name name of the (indexed, auto_now) date property
+        @param max_age age in seconds
+        @param clear list of names of properties to clear
+        """
+        super(ClearAfterMaxAge, self).__init__(property_name, max_age)
+        self.clear = list(clear)
+
+    def prune(self, model_class, keys, run):
+        cutoff = self.cutoff(run)
+
+        def txn(key):
+            # written since the query ran, e.g. a token refreshed by a signin
+            entity = key.get()
+            if entity is None or getattr(entity, self.property_name) >= cutoff:
+                return False
+            for name in self.clear:
+                setattr(entity, name, None)
+            entity.put()
+            return True
+        with model_cache.batch_generations():
+            run.cleared += sum(1 for k in keys if ndb.transaction(lambda: txn(k)))
+
+
+class Orphans(RetentionPolicy):
+    """Deletes entities whose parent no longer exists, root entities are
+    never considered orphans.
+    """
+    name = 'orphans'
+
+    def query(self, model_class, run):
+        return model_class.query()
+
+    def select(self, keys):
+        parents = list(set(k.parent() for k in keys if k.parent() is not None))
+        missing = set(p for p, e in zip(parents, ndb.get_multi(parents)) if e is None)
+        return [k for k in keys if k.parent() in missing]
+
+
+class Placeholders(RetentionPolicy):
+    """Deletes Setting placeholders (see GAEDataStoreConfiguration) no longer
+    referenced by the loaded settings, i.e. left behind by removed settings.
+    """
+    name = 'placeholders'
+
+    def query(self, model_class, run):
+        return model_class.query(Setting.value == PLACE_HOLDER)
+
+    def select(self, keys):
+        return [k for k in keys if k.id() not in GAEDataStoreConfiguration.referenced_ids]
+
+
+def policies_from_config(config):
+    """Returns the list of retention policies for given model settings.
+
+    @param config dictionary of retention settings for a model
+    """
+    policies = []
+    if config.get(K_MAX_AGE) and config.get(K_MAX_AGE_CLEAR):
+        policies.append(ClearAfterMaxAge(config.get(K_MAX_AGE_PROPERTY, 'updated_at'),
+            config[K_MAX_AGE], config[K_MAX_AGE_CLEAR]))
+    elif config.get(K_MAX_AGE):
+        policies.append(MaxAge(config.get(K_MAX_AGE_PROPERTY, 'created_at'), config[K_MAX_AGE]))
+    if config.get(K_ORPHANS):
+        policies.append(Orphans())
+    if config.get(K_PLACEHOLDERS):
+        policies.append(Placeholders())
+    return policies
+
+
+class Retention(object):
+    """Holds the retention policies per model kind and runs them.
+    """
+    def __init__(self):
+        self.models = {}
+        self.batch_size = 500
+        self.time_limit = 60
+        self.chain = tasks.TaskChain('retention', RetentionRun)
+
+    def init_config(self, config, model_classes):
+        """Set up the configured policies for given model classes, models
+        without policies are left alone.
+
+        @param config RETENTION settings
+        @param model_classes list of model classes
+        """
+        self.batch_size = config.get(K_BATCH_SIZE, self.batch_size)
+        self.time_limit = config.get(K_TIME_LIMIT, self.time_limit)
+        model_configs = config.get(K_MODELS) or {}
+        self.models = {}
+        for model_class in model_classes:
+            kind = model_class._get_kind()
+            policies = policies_from_config(model_configs.get(kind.upper()) or {})
+            if policies:
+                self.models[kind] = (model_class, policies)
+                logging.debug('Retention of %s: %s', kind, policies)
+
+    def start(self, kinds=None):
+        """Start a run for each given kind, unless one is in progress. Runs in
+        progress that stopped making progress (e.g. their task failed) are
+        resumed from their last checkpoint.
+
+        @param kinds optional list of kinds, defaults to all with policies
+        @returns dictionary of kind to 'started', 'resumed' or 'running'
+        """
+        now = datetime.datetime.utcnow()
+        rv = {}
+        with tasks.batch():
+            for kind in kinds or sorted(self.models):
+                if kind not in self.models:
+                    raise ValueError('No retention policies for {}'.format(kind))
+                run = RetentionRun.get_by_id(kind)
+                if run is None or run.finished_at is not None:
+                    run = RetentionRun(id=kind, started_at=now)
+                    run.put()
+                    rv[kind] = 'started'
+                elif self.chain.stalled(run, self.time_limit):
+                    self.chain.resume(run)
+                    run.put()
+                    rv[kind] = 'resumed'
+                else:
+                    rv[kind] = 'running'
+                    continue
+                self._defer(run)
+        return rv
+
+    def _defer(self, run):
+        run_retention.defer(run.key.id(), run.invocations, _task_name=self.chain.task_name(run))
+
+    def step(self, kind, invocation):
+        """Process batches of given kind's run until done or out of time, then
+        hand over to the next invocation.
+
+        @param kind the model kind
+        @param invocation number of invocations of the run so far
+        """
+        if kind not in self.models:
+            raise tasks.PermanentTaskFailure('No retention policies for {}'.format(kind))
+        model_class, policies = self.models[kind]
+        with self.chain.claimed(kind, invocation, self.time_limit) as run:
+            if run is None:
+                logging.info('Skipping retention of %s, invocation %s is stale', kind, invocation)
+                return
+            deadline = time.time() + self.time_limit
+            scanned, pruned = run.scanned, run.deleted + run.cleared
+            while run.policy < len(policies):
+                self._process_batch(model_class, policies[run.policy], run)
+                if time.time() >= deadline:
+                    break
+
+        if run.policy >= len(policies):
+            run.finished_at = datetime.datetime.utcnow()
+            run.put()
+            logging.info('Retention of %s done, deleted %s and cleared %s of %s entities '
+                'in %.1fs (%.1f/s)', kind, run.deleted, run.cleared, run.scanned, run.elapsed,
+                run.scanned / run.elapsed if run.elapsed else 0)
+        else:
+            logging.info('Retention of %s continues, pruned %s of %s entities',
+                kind, run.deleted + run.cleared - pruned, run.scanned - scanned)
+            self.chain.hand_over(run)
+            self._defer(run)
+
+    def _process_batch(self, model_class, policy, run):
+        start = time.time()
+        cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+        keys, next_cursor, more = policy.query(model_class, run).fetch_page(
+            self.batch_size, keys_only=True, start_cursor=cursor)
+        doomed = policy.select(keys)
+        if doomed:
+            policy.prune(model_class, doomed, run)
+        run.scanned += len(keys)
+        if more and next_cursor:
+            run.cursor = next_cursor.urlsafe()
+        else:
+            run.policy += 1
+            run.cursor = None
+        run.elapsed += time.time() - start
+        run.put()
+
+    def report(self):
+        """Returns the latest run for each kind with retention policies.
+        """
+        runs = ndb.get_multi([ndb.Key(RetentionRun, kind) for kind in sorted(self.models)])
+        return [run for run in runs if run is not None]
+
+
+retention = Retention()
+
+
+@tasks.task('retention.run')
+def run_retention(kind, invocation):
+    """Task processing the next batches of the retention run for given kind.
+    """
+    retention.step(kind, invocation)
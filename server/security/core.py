@@ -7,6 +7,7 @@ from flask import Flask, session, jsonify
 from requests_oauthlib import OAuth2Session
 from . import constants
 from ..models import User, OAuth
+from ..budgets import latency_budgets
 
 
 class UnauthorizedException(Exception):
@@ -94,7 +95,8 @@ class OAuth2Client(OAuthClient):
         return self.session.fetch_token(
             self.config.get(constants.K_OAUTH_TOKEN_URL),
             client_secret=self.config.get(constants.K_OAUTH_CLIENT_SECRET),
-            authorization_response=oauth_resp)
+            authorization_response=oauth_resp,
+            timeout=latency_budgets.provider_timeout())
 
     def post_construct(self, **kwargs):
         pass
@@ -0,0 +1,163 @@
+"""
+    server.serializers
+
+Registry of serializers keyed by mimetype, used to negotiate the response
+format from the Accept header. Objects are first turned into plain structures
+(see helpers.to_plain), which every serializer knows how to emit.
+"""
+import logging
+
+from abc import ABCMeta, abstractmethod
+from flask import json, request, current_app
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+from . import helpers
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MIME_TYPE_APPLICATION_MSGPACK = 'application/msgpack'
+MIME_TYPE_APPLICATION_X_MSGPACK = 'application/x-msgpack'
+
+
+class Serializer(object):
+    """Base class for serializers, encoding plain structures to bytes and back.
+    """
+    __metaclass__ = ABCMeta
+    # mimetypes handled by serializer, the first one is used for responses
+    mimetypes = []
+    name = None
+
+    @abstractmethod
+    def encode(self, obj):
+        """Encode given plain structure."""
+        pass
+
+    @abstractmethod
+    def decode(self, data):
+        """Decode given data into a plain structure."""
+        pass
+
+    def iter_encode(self, items, chunk_size=8192):
+        """Incrementally encode given list of plain structures, serializers
+        that can't do so encode the whole list at once.
+        """
+        yield self.encode(list(items))
+
+    @property
+    def mimetype(self):
+        return self.mimetypes[0]
+
+
+class JSONSerializer(Serializer):
+    mimetypes = [helpers.MIME_TYPE_APPLICATION_JSON]
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj, cls=helpers.JSONSerializableEncoder)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def iter_encode(self, items, chunk_size=8192):
+        return helpers.iter_json(items, chunk_size=chunk_size,
+            encoder=helpers.JSONSerializableEncoder())
+
+
+class MessagePackSerializer(Serializer):
+    mimetypes = [MIME_TYPE_APPLICATION_MSGPACK, MIME_TYPE_APPLICATION_X_MSGPACK]
+    name = 'msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def iter_encode(self, items, chunk_size=8192):
+        items = list(items)
+        packer = msgpack.Packer(use_bin_type=True)
+        buf = [packer.pack_array_header(len(items))]
+        size = len(buf[0])
+        for item in items:
+            encoded = packer.pack(item)
+            buf.append(encoded)
+            size += len(encoded)
+            if size >= chunk_size:
+                yield ''.join(buf)
+                buf, size = [], 0
+        yield ''.join(buf)
+
+
+class SerializerRegistry(object):
+    """Serializers keyed by mimetype. The first registered serializer is the
+    default, it's used when the client accepts anything.
+    """
+    def __init__(self):
+        self.serializers = {}
+        self.mimetypes = []
+
+    def register(self, serializer):
+        """Registers given serializer for each of its mimetypes.
+
+        @param serializer the Serializer instance
+        """
+        for mimetype in serializer.mimetypes:
+            if mimetype in self.serializers:
+                logging.warn('Serializer for "%s" already registered!', mimetype)
+                continue
+            self.serializers[mimetype] = serializer
+            self.mimetypes.append(mimetype)
+
+    def for_mimetype(self, mimetype):
+        """Returns the serializer for given mimetype, or None.
+        """
+        return self.serializers.get(mimetype)
+
+    def best_match(self, accept_mimetypes=None):
+        """Returns the serializer best matching given (or the current request's)
+        accepted mimetypes, falling back to the default serializer.
+
+        @param accept_mimetypes werkzeug MIMEAccept
+        """
+        if accept_mimetypes is None:
+            accept_mimetypes = request.accept_mimetypes
+        mimetype = accept_mimetypes.best_match(self.mimetypes, default=self.mimetypes[0])
+        return self.serializers[mimetype]
+
+
+registry = SerializerRegistry()
+registry.register(JSONSerializer())
+if msgpack is not None:
+    registry.register(MessagePackSerializer())
+
+
+def respond(obj, status=200):
+    """Respond with given object in the format negotiated from the Accept
+    header. Lists are encoded incrementally, one item at a time.
+
+    @param obj object (or list of objects) to respond with
+    @param status optional response status code
+    """
+    serializer = registry.best_match()
+    if isinstance(obj, (list, tuple)):
+        body = serializer.iter_encode(helpers.to_plain(item) for item in obj)
+    else:
+        body = serializer.encode(helpers.to_plain(obj))
+    resp = current_app.response_class(body, status=status, mimetype=serializer.mimetype)
+    resp.vary.add('Accept')
+    return resp
+
+
+def get_payload():
+    """Returns the decoded request body, according to its Content-Type.
+    """
+    serializer = registry.for_mimetype(request.mimetype)
+    if serializer is None:
+        raise UnsupportedMediaType()
+    try:
+        return serializer.decode(request.get_data())
+    except Exception as e:
+        logging.info('Unable to decode %s payload: %s', request.mimetype, e)
+        raise BadRequest()
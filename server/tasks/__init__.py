@@ -0,0 +1,52 @@
+"""
+    server.tasks
+"""
+from functools import wraps
+from flask import request, abort
+from core import TaskRunner, Task, TaskException, PermanentTaskFailure
+from chain import TaskChain
+from . import constants
+
+
+task_runner = TaskRunner()
+
+
+def task(name, retry_limit=None):
+    """Registers decorated function as a task handler. The decorated function
+    gains a `defer` attribute for enqueueing it, which takes the same arguments
+    as the function plus the optional `_task_name` and `_countdown` keywords.
+
+    @param name unique name of the task
+    @param retry_limit optional max number of retries, defaults to settings
+    """
+    def decorator(fn):
+        task_runner.register(name, fn, retry_limit=retry_limit)
+
+        def defer(*args, **kwargs):
+            task_name = kwargs.pop('_task_name', None)
+            countdown = kwargs.pop('_countdown', None)
+            return task_runner.enqueue(name, args, kwargs,
+                task_name=task_name, countdown=countdown)
+        fn.defer = defer
+        return fn
+    return decorator
+
+
+def batch():
+    """Collect all tasks enqueued within the returned context and add them together.
+    """
+    return task_runner.batch()
+
+
+def queue_only(fn):
+    """Decorates given function so it can only be called by the task queue,
+    App Engine strips the queue headers from external requests.
+
+    @param fn function to decorate
+    """
+    @wraps(fn)
+    def decorator(*args, **kwargs):
+        if constants.H_QUEUE_NAME not in request.headers:
+            abort(403)
+        return fn(*args, **kwargs)
+    return decorator
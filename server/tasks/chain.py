@@ -0,0 +1,99 @@
+import datetime
+
+from contextlib import contextmanager
+from google.appengine.ext import ndb
+from core import TaskException
+
+
+class TaskChain(object):
+    """A long running job processed by a chain of tasks, each invocation
+    working until its time limit, checkpointing its progress in an entity and
+    then handing over to the next. Tasks are named after their invocation, so
+    the same step isn't enqueued twice, and duplicate or stale tasks skip it.
+
+    The entity's model needs invocations (integer), claimed_at, started_at,
+    finished_at and updated_at (auto_now) properties.
+    """
+    def __init__(self, name, model_class):
+        """
+        @param name prefix of the task names
+        @param model_class model class of the checkpoint entities
+        """
+        self.name = name
+        self.model_class = model_class
+
+    def task_name(self, entity):
+        """Returns the task name for the current invocation of given entity.
+        """
+        return '{}-{}-{}-{}'.format(self.name, entity.key.id(),
+            entity.started_at.strftime('%Y%m%d%H%M%S'), entity.invocations)
+
+    def stalled(self, entity, time_limit):
+        """Returns whether given unfinished entity stopped making progress,
+        e.g. its task failed for good.
+
+        @param entity the checkpoint entity
+        @param time_limit seconds an invocation works for
+        """
+        return entity.updated_at < \
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=time_limit * 2)
+
+    def resume(self, entity):
+        """Hand given stalled entity over to a new invocation, the caller
+        saves it and enqueues its task.
+        """
+        entity.invocations += 1
+        entity.claimed_at = None
+
+    def hand_over(self, entity):
+        """Save given entity for its next invocation, the caller enqueues its
+        task.
+        """
+        entity.invocations += 1
+        entity.claimed_at = None
+        entity.put()
+
+    @contextmanager
+    def claimed(self, id, invocation, time_limit):
+        """Context manager claiming the entity with given id for given
+        invocation, so duplicate tasks don't process it in parallel. Yields
+        None for invocations the entity moved past. Should the block raise
+        the claim is released, so the task's retry can claim it again.
+
+        @param id id of the checkpoint entity
+        @param invocation number of invocations so far
+        @param time_limit seconds an invocation works for, its claim is
+                          respected for twice as long
+        @raises TaskException while another task holds the invocation, so
+                this one is retried once it finished (or died)
+        """
+        lease = datetime.datetime.utcnow() - datetime.timedelta(seconds=time_limit * 2)
+
+        def claim():
+            entity = self.model_class.get_by_id(id)
+            if entity is None or entity.finished_at is not None \
+              or entity.invocations != invocation:
+                return None
+            if entity.claimed_at is not None and entity.claimed_at > lease:
+                raise TaskException('{} {} invocation {} is in progress'.format(
+                    self.model_class.__name__, id, invocation))
+            entity.claimed_at = datetime.datetime.utcnow()
+            entity.put()
+            return entity
+
+        def release():
+            entity = self.model_class.get_by_id(id)
+            if entity is not None and entity.invocations == invocation:
+                entity.claimed_at = None
+                entity.put()
+
+        entity = ndb.transaction(claim)
+        try:
+            yield entity
+        except BaseException:
+            # the task is retried, and picks up from the last checkpoint
+            if entity is not None:
+                ndb.transaction(release)
+            raise
+        if entity is not None:
+            entity.claimed_at = None
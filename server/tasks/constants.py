@@ -0,0 +1,15 @@
+TASKS_URL_PREFIX = '/_tasks'
+
+K_BACKEND = 'BACKEND'
+K_QUEUE_NAME = 'QUEUE_NAME'
+K_RETRY_LIMIT = 'RETRY_LIMIT'
+K_RETRY_DELAY = 'RETRY_DELAY'
+K_BATCH_SIZE = 'BATCH_SIZE'
+K_SYNCHRONOUS = 'SYNCHRONOUS'
+
+# task names remembered by the local backend to skip duplicates
+NAMES_LIMIT = 10000
+# SERVER_SOFTWARE of unit tests, which run tasks in process
+TESTBED_SUFFIX = '(testbed)'
+
+H_QUEUE_NAME = 'X-AppEngine-QueueName'
@@ -0,0 +1,308 @@
+import json
+import logging
+import os
+import threading
+import time
+import Queue
+
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from google.appengine.api import taskqueue
+from . import constants
+
+
+class TaskException(Exception):
+    """Generic task related exception.
+    """
+    pass
+
+class PermanentTaskFailure(TaskException):
+    """Raised by a task (or the runner) to signal the task should not be retried.
+    """
+    pass
+
+
+class Task(object):
+    """A unit of deferred work, references a registered task handler by name
+    along with the arguments the handler should be called with.
+    """
+    def __init__(self, name, args=None, kwargs=None, task_name=None, countdown=None):
+        """
+        @param name name of the registered task handler
+        @param args list of positional arguments, must be JSON serializable
+        @param kwargs dictionary of keyword arguments, must be JSON serializable
+        @param task_name optional unique name, tasks with same name are only run once
+        @param countdown optional seconds to wait before running the task
+        """
+        self.name = name
+        self.args = list(args or [])
+        self.kwargs = dict(kwargs or {})
+        self.task_name = task_name
+        self.countdown = countdown
+
+    def payload(self):
+        """Returns the serialized arguments for this task.
+        """
+        return json.dumps(dict(args=self.args, kwargs=self.kwargs))
+
+    @classmethod
+    def from_payload(cls, name, payload):
+        """Creates a Task for the given handler name from serialized arguments.
+
+        @param name name of the registered task handler
+        @param payload serialized arguments, see Task.payload
+        """
+        try:
+            data = json.loads(payload) if payload else {}
+        except ValueError:
+            raise PermanentTaskFailure('Unable to parse payload for task {}'.format(name))
+        return cls(name, args=data.get('args'), kwargs=data.get('kwargs'))
+
+    def __repr__(self):
+        return 'Task(%s, task_name=%s)' % (self.name, self.task_name)
+
+
+class TaskBackend(object):
+    """Base class for backends that take care of actually running tasks.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, runner, config):
+        self.runner = runner
+        self.config = config
+
+    @abstractmethod
+    def add(self, tasks):
+        """Enqueue the given tasks.
+
+        @param tasks list of Task to enqueue
+        """
+        pass
+
+    def drain(self):
+        """Block until all enqueued tasks are done, only meaningful for
+        backends running in process.
+        """
+        pass
+
+
+class LocalTaskBackend(TaskBackend):
+    """In process backend meant for development and tests. Tasks are run on
+    a background worker thread, or immediately if configured as synchronous.
+    """
+    def __init__(self, runner, config):
+        super(LocalTaskBackend, self).__init__(runner, config)
+        self.synchronous = config.get(constants.K_SYNCHRONOUS, False)
+        self._queue = Queue.Queue()
+        # names of the latest tasks added, oldest are forgotten first
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def add(self, tasks):
+        for task in tasks:
+            if not self._claim_name(task):
+                logging.info('Skipping %s, a task with same name was already added', task)
+                continue
+            if self.synchronous:
+                self.runner.run_with_retries(task)
+            else:
+                self._ensure_worker()
+                self._queue.put(task)
+
+    def drain(self):
+        self._queue.join()
+
+    def _claim_name(self, task):
+        """Returns False if a task with the same name was previously added.
+        """
+        if task.task_name is None:
+            return True
+        with self._lock:
+            if task.task_name in self._names:
+                return False
+            self._names[task.task_name] = True
+            if len(self._names) > constants.NAMES_LIMIT:
+                self._names.popitem(last=False)
+            return True
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name='local-task-worker')
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                self.runner.run_with_retries(task)
+            finally:
+                self._queue.task_done()
+
+
+class PushTaskBackend(TaskBackend):
+    """Backend that hands tasks off to an App Engine push queue, the queue
+    will call back into the application (see constants.TASKS_URL_PREFIX).
+    """
+    def __init__(self, runner, config):
+        super(PushTaskBackend, self).__init__(runner, config)
+        self.queue = taskqueue.Queue(config.get(constants.K_QUEUE_NAME, 'default'))
+        self.batch_size = min(config.get(constants.K_BATCH_SIZE, taskqueue.MAX_TASKS_PER_ADD),
+            taskqueue.MAX_TASKS_PER_ADD)
+
+    def add(self, tasks):
+        gae_tasks = [self._to_gae_task(t) for t in tasks]
+        for i in range(0, len(gae_tasks), self.batch_size):
+            try:
+                self.queue.add(gae_tasks[i:i + self.batch_size])
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError) as e:
+                # remaining tasks in the batch are still added
+                logging.info('Skipping tasks with previously used names: %s', e)
+
+    def _to_gae_task(self, task):
+        retry_limit = self.runner.retry_limit(task.name)
+        return taskqueue.Task(
+            url='{}/{}'.format(constants.TASKS_URL_PREFIX, task.name),
+            payload=task.payload(),
+            name=task.task_name,
+            countdown=task.countdown,
+            retry_options=taskqueue.TaskRetryOptions(task_retry_limit=retry_limit),
+            headers={'Content-Type': 'application/json'})
+
+
+class TaskRunner(object):
+    """Registry of task handlers, and entry point for enqueueing and running
+    tasks with the configured backend.
+    """
+    BACKENDS = {
+        'local': LocalTaskBackend,
+        'push': PushTaskBackend
+    }
+
+    def __init__(self):
+        self.handlers = {}
+        self.config = {}
+        self.backend = None
+        self._batches = threading.local()
+
+    def init_config(self, config):
+        """Initialize the runner and its backend with given settings.
+
+        @param config TASKS settings
+        """
+        if self.backend is not None and self.config == config:
+            # already initialized, e.g. by another sub application
+            return
+        self.config = dict(config)
+        backend = self.config.get(constants.K_BACKEND, 'auto')
+        if backend == 'auto':
+            # App Engine and dev_appserver both have push queues, the latter
+            # also waits for threads started by a request before finishing it
+            server_software = os.environ.get('SERVER_SOFTWARE', '')
+            has_queues = bool(server_software) and not server_software.endswith(constants.TESTBED_SUFFIX)
+            backend = 'push' if has_queues else 'local'
+        if backend not in self.BACKENDS:
+            raise TaskException('Unknown task backend {}'.format(backend))
+        self.backend = self.BACKENDS[backend](self, self.config)
+
+    def register(self, name, fn, retry_limit=None):
+        """Registers a task handler under the given name.
+
+        @param name unique name of handler
+        @param fn function to call when running the task
+        @param retry_limit optional max number of retries, defaults to settings
+        """
+        if name in self.handlers:
+            logging.warn('Task "%s" already registered!', name)
+        self.handlers[name] = (fn, retry_limit)
+
+    def retry_limit(self, name):
+        """Returns the max number of retries for given task handler.
+        """
+        _, retry_limit = self._get_handler(name)
+        return retry_limit if retry_limit is not None \
+            else self.config.get(constants.K_RETRY_LIMIT, 0)
+
+    def enqueue(self, name, args=None, kwargs=None, task_name=None, countdown=None):
+        """Enqueue a task for given handler, if called within a batch the
+        task is held until the batch completes.
+
+        @param name name of the registered task handler
+        @param args list of positional arguments for handler
+        @param kwargs dictionary of keyword arguments for handler
+        @param task_name optional unique name making the enqueue idempotent
+        @param countdown optional seconds to wait before running the task
+        """
+        self._get_handler(name)
+        task = Task(name, args, kwargs, task_name=task_name, countdown=countdown)
+        pending = getattr(self._batches, 'pending', None)
+        if pending is not None:
+            pending.append(task)
+        else:
+            self._get_backend().add([task])
+        return task
+
+    @contextmanager
+    def batch(self):
+        """Context manager that collects all tasks enqueued within it and adds
+        them to the backend together when it exits.
+        """
+        if getattr(self._batches, 'pending', None) is not None:
+            # nested batch, outer batch will take care of it
+            yield
+            return
+        self._batches.pending = []
+        try:
+            yield
+            pending = self._batches.pending
+        finally:
+            self._batches.pending = None
+        if pending:
+            self._get_backend().add(pending)
+
+    def run(self, task):
+        """Runs the given task once.
+
+        @param task the Task to run
+        """
+        fn, _ = self._get_handler(task.name)
+        return fn(*task.args, **task.kwargs)
+
+    def run_with_retries(self, task):
+        """Runs the given task, retrying on failure up to its retry limit.
+        Used by in process backends, push queues handle retries themselves.
+        The delay between attempts starts at RETRY_DELAY seconds and doubles
+        after every attempt.
+
+        @param task the Task to run
+        """
+        attempts = self.retry_limit(task.name) + 1
+        delay = self.config.get(constants.K_RETRY_DELAY, 0)
+        for attempt in range(attempts):
+            try:
+                return self.run(task)
+            except PermanentTaskFailure as e:
+                logging.error('%s failed permanently: %s', task, e)
+                return
+            except Exception:
+                logging.exception('%s failed on attempt %s of %s', task, attempt + 1, attempts)
+            if delay and attempt + 1 < attempts:
+                time.sleep(delay * 2 ** attempt)
+
+    def drain(self):
+        """Block until all enqueued tasks are done (local backend only).
+        """
+        self._get_backend().drain()
+
+    def _get_handler(self, name):
+        if name not in self.handlers:
+            raise PermanentTaskFailure('Task {} not found!'.format(name))
+        return self.handlers[name]
+
+    def _get_backend(self):
+        if self.backend is None:
+            raise TaskException('TaskRunner has not been initialized!')
+        return self.backend
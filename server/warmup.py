@@ -0,0 +1,51 @@
+"""
+    server.warmup
+"""
+import logging
+import time
+
+from .cache import model_cache
+from .models import User, AbstractModel
+from .security import oauth_factory
+
+
+def _prime_oauth_clients():
+    """Create a client per provider, which sets up the underlying sessions.
+    """
+    for provider_id in oauth_factory.clients:
+        oauth_factory.create_client(provider_id)
+
+
+def _prime_cache():
+    """Prime the memcache entries hot routes need, i.e. the model generations
+    used for ETags and the first page of users.
+    """
+    for model_class in AbstractModel.subclasses():
+        model_cache.generation(model_class._get_kind())
+    User.list()
+
+
+STEPS = [
+    ('oauth_clients', _prime_oauth_clients),
+    ('cache', _prime_cache),
+]
+
+
+def warmup():
+    """Runs each warmup step, a failing step is logged and skipped since
+    warmup is best effort. Settings are already resolved, and both sub
+    applications built, by the time a request is handled.
+
+    @returns dictionary of step name to seconds taken (None if it failed)
+    """
+    timings = {}
+    for name, step in STEPS:
+        start = time.time()
+        try:
+            step()
+            timings[name] = time.time() - start
+        except Exception:
+            logging.exception('Warmup step %s failed', name)
+            timings[name] = None
+    logging.info('Warmup done: %s', timings)
+    return timings
@@ -6,7 +6,7 @@ import json
 from google.appengine.ext import testbed
 from google.appengine.ext import ndb
 from flask import current_app
-from server import create_app, models, settings
+from server import create_app, models
 
 
 class BaseTestCase(object):
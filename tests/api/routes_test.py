@@ -1,14 +1,27 @@
+import gzip
 import json
+import msgpack
 import pytest
 
+from StringIO import StringIO
+
+from google.appengine.api import apiproxy_stub_map, memcache
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import testbed
 from tests import BaseTestCase
 from server import api, models
+from server.cache import model_cache
 
 class TestApiRoutes(BaseTestCase):
     def create_app(self):
         return api.create_app()
     
+    @pytest.fixture
+    def settled(self, app, monkeypatch):
+        """Tests with this fixture have writes show up in queries right away.
+        """
+        monkeypatch.setattr(model_cache, 'settle_time', 0)
+
     @pytest.fixture
     def with_users(self, app):
         """Tests with this fixture will have the following users injected into
@@ -48,4 +61,92 @@ class TestApiRoutes(BaseTestCase):
 
         created_user = json.loads(resp.get_data(as_text=True))
         assert created_user['name'] == 'neo' and created_user['email'] == 'neo@acme.org'
-        assert models.User.query().count() == 3
\ No newline at end of file
+        assert models.User.query().count() == 3
+
+
+    def test_api_should_gzip_large_list_of_users(self, app, client, settled):
+        """Test should gzip the list of users when client accepts it.
+        """
+        for n in range(50):
+            models.User.create(name='user%s' % n, email='user%s@acme.org' % n)
+
+        resp = client.get('/api/users', headers=self.make_headers({'Accept-Encoding': 'gzip'}))
+
+        self.assert_valid_response(resp)
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        users = json.loads(gzip.GzipFile(fileobj=StringIO(resp.get_data())).read())
+        assert len(users) == 50
+
+        # the compressed response revalidates like the identity one
+        assert resp.headers['ETag'].startswith('W/')
+        resp = client.get('/api/users', headers=self.make_headers({
+            'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag']}))
+        assert resp.status_code == 304
+
+
+    def test_api_should_not_gzip_when_refused(self, app, client):
+        """Test should leave the list of users alone when gzip has a zero quality.
+        """
+        for n in range(50):
+            models.User.create(name='user%s' % n, email='user%s@acme.org' % n)
+
+        resp = client.get('/api/users', headers=self.make_headers({'Accept-Encoding': 'gzip;q=0, identity'}))
+
+        self.assert_valid_response(resp)
+        assert 'Content-Encoding' not in resp.headers
+        assert len(json.loads(resp.get_data())) == 50
+
+
+    def test_api_should_revalidate_list_of_users(self, app, client, settled, with_users):
+        """Test should answer a revalidation with 304 until users change.
+        """
+        resp = client.get('/api/users', headers=self.make_headers())
+        etag = resp.headers['ETag']
+
+        resp = client.get('/api/users', headers=self.make_headers({'If-None-Match': etag}))
+        assert resp.status_code == 304
+
+        models.User.create(name='neo', email='neo@acme.org')
+        resp = client.get('/api/users', headers=self.make_headers({'If-None-Match': etag}))
+        self.assert_valid_response(resp)
+        assert resp.headers['ETag'] != etag
+
+
+    def test_api_should_negotiate_msgpack(self, app, client, with_users):
+        """Test should list and create users with MessagePack when asked for.
+        """
+        headers = {'Accept': 'application/msgpack', 'Content-Type': 'application/msgpack'}
+        resp = client.get('/api/users', headers=headers)
+
+        self.assert_valid_response(resp, content_type='application/msgpack')
+        users = msgpack.unpackb(resp.get_data(), raw=False)
+        assert sorted(u['name'] for u in users) == ['bar', 'foo']
+
+        resp = client.post('/api/users', headers=headers,
+            data=msgpack.packb(dict(name='neo', email='neo@acme.org'), use_bin_type=True))
+
+        self.assert_valid_response(resp, content_type='application/msgpack')
+        assert msgpack.unpackb(resp.get_data(), raw=False)['name'] == 'neo'
+
+
+    def test_api_should_not_tie_unsettled_list_to_new_etag(self, app, client, with_users):
+        """Test should neither cache nor tag the list of users until global
+        queries reflect the latest write.
+        """
+        datastore = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        # writes never show up in global queries, until changed below
+        datastore.SetConsistencyPolicy(datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0))
+        client.post('/api/users', headers=self.make_headers(),
+            data=json.dumps(dict(name='neo', email='neo@acme.org')))
+        for _ in range(2):
+            resp = client.get('/api/users', headers=self.make_headers())
+            self.assert_valid_response(resp)
+            assert 'ETag' not in resp.headers
+
+        # queries caught up, and the settle time is over
+        datastore.SetConsistencyPolicy(datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        memcache.delete(model_cache.UNSETTLED_PREFIX + 'User')
+        resp = client.get('/api/users', headers=self.make_headers())
+        assert 'neo' in [u['name'] for u in json.loads(resp.get_data())]
+        resp = client.get('/api/users', headers=self.make_headers({'If-None-Match': resp.headers['ETag']}))
+        assert resp.status_code == 304
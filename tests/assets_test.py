@@ -0,0 +1,43 @@
+import gzip
+import json
+import os
+
+from server.assets import collect, AssetManifest
+
+
+class TestAssets(object):
+    def make_build(self, build_dir):
+        """Lay out a minimal client build in given directory.
+        """
+        os.makedirs(str(build_dir.join('static', 'js')))
+        build_dir.join('static', 'js', 'main.1a2b3c.js').write('console.log("hi");' * 100)
+        build_dir.join('favicon.ico').write('ico')
+        build_dir.join('index.html').write('<html></html>')
+        build_dir.join('asset-manifest.json').write(json.dumps({
+            'main.js': 'static/js/main.1a2b3c.js'}))
+
+    def test_should_collect_build_into_static(self, tmpdir):
+        build_dir, static_dir = tmpdir.join('build'), tmpdir.join('static')
+        self.make_build(build_dir)
+
+        manifest = collect(str(build_dir), str(static_dir))
+
+        assert manifest == {'main.js': '/static/js/main.1a2b3c.js'}
+        assert static_dir.join('js', 'main.1a2b3c.js').check()
+        assert static_dir.join('favicon.ico').check()
+        assert not static_dir.join('index.html').check()
+        # large text assets get a precompressed variant, tiny ones don't
+        assert not static_dir.join('favicon.ico.gz').check()
+        gz = gzip.open(str(static_dir.join('js', 'main.1a2b3c.js.gz')))
+        assert gz.read() == static_dir.join('js', 'main.1a2b3c.js').read()
+
+    def test_manifest_should_resolve_asset_urls(self, tmpdir):
+        build_dir, static_dir = tmpdir.join('build'), tmpdir.join('static')
+        self.make_build(build_dir)
+        collect(str(build_dir), str(static_dir))
+
+        manifest = AssetManifest()
+        manifest.init_config(dict(STATIC_DIR=str(static_dir)))
+
+        assert manifest.url_for('main.js') == '/static/js/main.1a2b3c.js'
+        assert manifest.url_for('main.css') == '/static/main.css'
@@ -0,0 +1,66 @@
+"""
+Measures cold start latency, i.e. the first requests a fresh process serves,
+with and without running warmup first. Each run uses a new process against
+testbed stubs, run with:
+
+    $ PYTHONPATH=. python tests/benchmarks/coldstart_bench.py [runs]
+"""
+import json
+import subprocess
+import sys
+import time
+
+PATHS = ['/api/users', '/']
+
+
+def child(use_warmup):
+    """Runs in a fresh process, prints timings as JSON.
+    """
+    from google.appengine.ext import testbed
+    _testbed = testbed.Testbed()
+    _testbed.activate()
+    _testbed.init_datastore_v3_stub()
+    _testbed.init_memcache_stub()
+    _testbed.init_urlfetch_stub()
+
+    timings = {}
+    start = time.time()
+    import run
+    timings['import'] = time.time() - start
+
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+    client = Client(run.app, BaseResponse)
+    if use_warmup:
+        start = time.time()
+        client.get('/_ah/warmup')
+        timings['warmup'] = time.time() - start
+    for path in PATHS:
+        start = time.time()
+        client.get(path, headers={'Accept': 'application/json'})
+        timings[path] = time.time() - start
+    print(json.dumps(timings))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(runs):
+    for use_warmup in (False, True):
+        results = []
+        for _ in range(runs):
+            out = subprocess.check_output([sys.executable, __file__, '--child', str(int(use_warmup))])
+            results.append(json.loads(out.strip().splitlines()[-1]))
+        print('with warmup' if use_warmup else 'without warmup')
+        for name in sorted(results[0]):
+            print('  {:<12} {:8.1f} ms (median of {})'.format(
+                name, median([r[name] for r in results]) * 1000, runs))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        child(sys.argv[2] == '1')
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
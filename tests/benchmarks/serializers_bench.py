@@ -0,0 +1,45 @@
+"""
+Compares encode/decode speed and payload size of the registered serializers
+on a page of users, run with:
+
+    $ PYTHONPATH=. python tests/benchmarks/serializers_bench.py [users]
+"""
+import sys
+import timeit
+import zlib
+
+from datetime import datetime
+from server import helpers, serializers
+
+N = 200
+
+
+def make_users(count):
+    """Plain structures shaped like User.to_plain output.
+    """
+    return [helpers.to_plain(dict(
+        key='ahJzfmdhZS1weXRob24tc3RhcnRlcnIRCxIEVXNlchiAgIDA%06dCww' % i,
+        name='user %s' % i,
+        email='user%s@acme.org' % i,
+        created_at=datetime(2018, 3, 1, 12, 0, i % 60))) for i in range(count)]
+
+
+def main(count):
+    users = make_users(count)
+    seen = set()
+    print('{:<10} {:>12} {:>12} {:>10} {:>10}'.format(
+        'format', 'encode (us)', 'decode (us)', 'bytes', 'gzipped'))
+    for mimetype in serializers.registry.mimetypes:
+        serializer = serializers.registry.for_mimetype(mimetype)
+        if serializer.name in seen:
+            continue
+        seen.add(serializer.name)
+        data = ''.join(serializer.iter_encode(users))
+        encode = timeit.timeit(lambda: ''.join(serializer.iter_encode(users)), number=N) / N
+        decode = timeit.timeit(lambda: serializer.decode(data), number=N) / N
+        print('{:<10} {:>12.1f} {:>12.1f} {:>10} {:>10}'.format(
+            serializer.name, encode * 1e6, decode * 1e6, len(data), len(zlib.compress(data, 6))))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,60 @@
+"""
+Measures throughput of a running server (see `python run.py serve`), i.e.
+requests per second overall and per worker process, run with:
+
+    $ python run.py serve --api-server localhost:8000 --workers 4 --threads 8 &
+    $ PYTHONPATH=. python tests/benchmarks/throughput_bench.py [url] [concurrency] [seconds] [workers]
+"""
+import sys
+import threading
+import time
+import urllib2
+
+from collections import Counter
+
+
+def client(url, deadline, results):
+    latencies, errors = [], Counter()
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            urllib2.urlopen(urllib2.Request(url, headers={'Accept': 'application/json'})).read()
+            latencies.append(time.time() - start)
+        except urllib2.HTTPError as e:
+            # e.g. 429 once the API rate limit kicks in
+            errors[e.code] += 1
+        except Exception as e:
+            errors[type(e).__name__] += 1
+    results.append((latencies, errors))
+
+
+def main(url, concurrency, seconds, workers):
+    results = []
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=client, args=(url, deadline, results))
+        for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies = sorted(l for r in results for l in r[0])
+    errors = sum((r[1] for r in results), Counter())
+    rps = len(latencies) / float(seconds)
+    print('{} with {} clients for {}s'.format(url, concurrency, seconds))
+    print('  requests      {:8d} (errors: {})'.format(len(latencies), dict(errors) or 'none'))
+    print('  req/s         {:8.1f}'.format(rps))
+    print('  req/s/worker  {:8.1f} ({} workers)'.format(rps / workers, workers))
+    if latencies:
+        for p in (50, 90, 99):
+            print('  p{:<12} {:8.1f} ms'.format(p,
+                latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000))
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    args = sys.argv[1:]
+    main(args[0] if len(args) > 0 else 'http://127.0.0.1:8080/api/users',
+        int(args[1]) if len(args) > 1 else 16,
+        int(args[2]) if len(args) > 2 else 10,
+        int(args[3]) if len(args) > 3 else multiprocessing.cpu_count())
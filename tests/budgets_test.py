@@ -0,0 +1,106 @@
+import json
+import time
+import pytest
+
+from flask import g
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from tests import BaseTestCase
+from server import api, models
+from server.budgets import latency_budgets, Budget, BudgetExceeded, H_FALLBACK
+
+
+class TestLatencyBudgets(BaseTestCase):
+    def create_app(self):
+        return api.create_app()
+
+    def time_out_datastore(self, monkeypatch):
+        """Have every User query and write time out.
+        """
+        def timeout(*args, **kwargs):
+            raise datastore_errors.Timeout()
+        monkeypatch.setattr(models.User, 'list', classmethod(timeout))
+        monkeypatch.setattr(models.User, 'create', classmethod(timeout))
+
+    def stats(self, name):
+        latency_budgets.stats.flush()
+        return latency_budgets.get_stats()[name]
+
+    def test_should_derive_deadlines_from_remaining_budget(self, app):
+        with app.test_request_context('/api/users'):
+            # no budget, no deadline
+            assert latency_budgets.datastore_options() == {}
+            g.budget = Budget('API_READ', 0.2, 'FAIL')
+            assert 0.1 < latency_budgets.datastore_options()['deadline'] <= 0.2
+            assert latency_budgets.provider_timeout() <= 0.2
+            time.sleep(0.2)
+            with pytest.raises(BudgetExceeded):
+                latency_budgets.datastore_options()
+
+    def test_should_serve_cached_response_out_of_time(self, app, client, monkeypatch):
+        models.User.create(name='foo')
+        good = client.get('/api/users', headers=self.make_headers())
+        assert good.status_code == 200
+        # streamed, kept once the whole body was sent
+        body = good.get_data()
+
+        self.time_out_datastore(monkeypatch)
+        resp = client.get('/api/users', headers=self.make_headers())
+        assert resp.status_code == 200
+        assert resp.headers[H_FALLBACK] == 'cached'
+        # may be stale, so clients shouldn't revalidate against it
+        assert 'ETag' not in resp.headers
+        assert json.loads(resp.get_data()) == json.loads(body)
+        stats = self.stats('API_READ')
+        assert stats['datastore_timeouts'] == 1
+        assert stats['served_cached'] == 1
+
+    def test_should_fail_fast_out_of_time(self, app, client, monkeypatch):
+        self.time_out_datastore(monkeypatch)
+        resp = client.post('/api/users', headers=self.make_headers(),
+            data=json.dumps(dict(name='foo')))
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == '1'
+        assert self.stats('API_WRITE')['failed'] == 1
+
+    def test_should_not_keep_partly_sent_streamed_response(self, app, client, monkeypatch):
+        models.User.create(name='foo')
+        # e.g. the client went away, the body was never read
+        client.get('/api/users', headers=self.make_headers()).close()
+
+        self.time_out_datastore(monkeypatch)
+        resp = client.get('/api/users', headers=self.make_headers())
+        assert resp.status_code == 503
+
+    def test_should_refresh_kept_response_only_once_stale(self, app, client, monkeypatch):
+        models.User.create(name='foo')
+        kept = []
+        monkeypatch.setattr(latency_budgets, '_keep', lambda *args: kept.append(args))
+        for _ in range(3):
+            client.get('/api/users', headers=self.make_headers()).get_data()
+        assert len(kept) == 1
+
+        monkeypatch.setattr(latency_budgets, 'fallback_refresh', 0)
+        memcache.flush_all()
+        client.get('/api/users', headers=self.make_headers()).get_data()
+        assert len(kept) == 2
+
+    def test_should_not_keep_response_too_large_for_memcache(self, app, client, monkeypatch):
+        models.User.create(name='foo')
+        monkeypatch.setattr(latency_budgets, 'MAX_FALLBACK_SIZE', 10)
+        client.get('/api/users', headers=self.make_headers()).get_data()
+
+        self.time_out_datastore(monkeypatch)
+        resp = client.get('/api/users', headers=self.make_headers())
+        assert resp.status_code == 503
+
+    def test_should_give_signin_user_lookup_a_deadline(self, app, monkeypatch):
+        info = dict(identity='foo', provider_id='google', token=dict(access_token='foo'))
+        user = models.User.get_or_create_by_oauth_info(info)
+        calls = []
+        deadline = latency_budgets.datastore_options
+        monkeypatch.setattr(latency_budgets, 'datastore_options',
+            lambda: calls.append(1) or deadline())
+        assert models.User.get_or_create_by_oauth_info(info).key == user.key
+        # finding the identity, and getting its user
+        assert len(calls) == 2
@@ -0,0 +1,199 @@
+import json
+import threading
+import time
+import pytest
+
+from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from tests import BaseTestCase
+from server import frontend, models
+from server.cache import ModelCache, SingleFlight, CacheStats, model_cache
+
+
+class CachedModel(models.AbstractModel):
+    name = ndb.StringProperty()
+
+
+class TestModelCache(BaseTestCase):
+    def create_app(self):
+        return frontend.create_app()
+
+    @pytest.fixture(autouse=True)
+    def policy(self, app):
+        """Setup a cache policy for CachedModel for each test.
+        """
+        model_cache.init_config(dict(STATS_FLUSH_INTERVAL=1000, MODELS=dict(CACHEDMODEL=dict(
+            USE_CACHE=False, USE_MEMCACHE=True, MEMCACHE_TIMEOUT=60,
+            NEGATIVE_CACHE_TIMEOUT=60))), [CachedModel])
+        # start counting from scratch
+        model_cache.stats.flush()
+        memcache.flush_all()
+
+    @pytest.fixture
+    def datastore_gets(self, monkeypatch):
+        """Tests with this fixture get the keys fetched from the datastore.
+        """
+        gets = []
+        get = ndb.Key.get
+        def recording_get(key, **ctx_options):
+            if ctx_options.get('use_datastore', True):
+                gets.append(key)
+            return get(key, **ctx_options)
+        monkeypatch.setattr(ndb.Key, 'get', recording_get)
+        return gets
+
+    def stats(self):
+        return model_cache.get_stats()['models']['CachedModel']
+
+    def test_should_apply_policy_to_model_class(self):
+        assert CachedModel._use_cache is False
+        assert CachedModel._use_memcache is True
+        assert CachedModel._memcache_timeout == 60
+
+    def test_should_remember_miss(self, datastore_gets):
+        assert CachedModel.get_by_id('missing') is None
+        assert CachedModel.get_by_id('missing') is None
+        assert datastore_gets == [ndb.Key(CachedModel, 'missing')]
+        stats = self.stats()
+        assert (stats['lookup'], stats['miss'], stats['negative_hit']) == (1, 1, 1)
+
+    def test_should_forget_miss_once_saved(self):
+        assert CachedModel.get_by_id('later') is None
+        CachedModel(id='later', name='foo').put()
+        assert CachedModel.get_by_id('later').name == 'foo'
+
+    def test_should_count_memcache_hits(self, datastore_gets):
+        key = CachedModel(id='foo', name='foo').put()
+        assert CachedModel.get_by_id('foo').name == 'foo'
+        assert CachedModel.get_by_id('foo').name == 'foo'
+        assert datastore_gets == [key]
+        stats = self.stats()
+        assert (stats['lookup'], stats['memcache_hit']) == (1, 1)
+        assert stats['memcache_hit_rate'] == 0.5
+
+    def test_should_only_bump_tracked_kinds(self, monkeypatch):
+        monkeypatch.setattr(model_cache, 'tracked', set(model_cache.tracked))
+        CachedModel(id='foo', name='foo').put()
+        assert memcache.get(ModelCache.GENERATION_PREFIX + 'CachedModel') is None
+        gen = model_cache.generation('CachedModel')
+        model_cache.track('CachedModel')
+        CachedModel(id='foo', name='bar').put()
+        assert model_cache.generation('CachedModel') == gen + 1
+
+    def test_should_wait_for_other_instance_loading_entity(self, datastore_gets):
+        key = ndb.Key(CachedModel, 'foo')
+        memcache.add(SingleFlight.LEASE_PREFIX + 'entity:' + key.urlsafe(), True)
+        def other_instance():
+            CachedModel(id='foo', name='foo').put()
+            # fills memcache
+            key.get()
+        threading.Timer(0.2, other_instance).start()
+        assert CachedModel.get_by_id('foo').name == 'foo'
+        assert datastore_gets == [key]
+
+    def test_should_report_stats(self, client):
+        CachedModel(id='foo', name='foo').put()
+        CachedModel.get_by_id('foo')
+        CachedModel.get_by_id('foo')
+        resp = client.get('/_admin/cache')
+        assert resp.status_code == 200
+        report = json.loads(resp.get_data())
+        assert report['models']['CachedModel']['memcache_hit'] == 1
+        assert 'hits' in report['memcache']
+
+    def test_should_flush_counters(self):
+        stats = CacheStats(flush_interval=2)
+        stats.record('Kind', 'lookup')
+        assert memcache.get(CacheStats.PREFIX + 'Kind:lookup') is None
+        stats.record('Kind', 'lookup')
+        assert memcache.get(CacheStats.PREFIX + 'Kind:lookup') == 2
+        stats.record('Kind', 'miss')
+        stats.flush()
+        assert memcache.get(CacheStats.PREFIX + 'Kind:miss') == 1
+
+
+class TestSingleFlight(BaseTestCase):
+    def create_app(self):
+        return frontend.create_app()
+
+    @pytest.fixture(autouse=True)
+    def stubs(self, app):
+        """Datastore and memcache stubs for each test, stubs are shared by
+        all threads.
+        """
+        pass
+
+    def run_concurrently(self, fn, n=10):
+        """Call fn from n threads at once, returns their results.
+        """
+        barrier = threading.Event()
+        results = [None] * n
+        def run(i):
+            barrier.wait()
+            results[i] = fn()
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        barrier.set()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_should_compute_once_for_concurrent_callers(self):
+        single_flight = SingleFlight()
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 42
+        assert self.run_concurrently(lambda: single_flight.do('k', compute)) == [42] * 10
+        assert len(calls) == 1
+        # nothing in flight anymore, next caller computes again
+        assert single_flight.do('k', compute) == 42
+        assert len(calls) == 2
+
+    def test_should_not_look_up_missing_result(self):
+        single_flight = SingleFlight()
+        lookups = []
+        def compute():
+            time.sleep(0.2)
+            return None
+        def lookup():
+            lookups.append(1)
+        assert self.run_concurrently(
+            lambda: single_flight.do('k', compute, lookup=lookup, lease=False)) == [None] * 10
+        assert lookups == []
+
+    def test_should_wait_for_lease_held_by_other_instance(self):
+        single_flight = SingleFlight(lease_timeout=2)
+        memcache.add(SingleFlight.LEASE_PREFIX + 'k', True)
+        threading.Timer(0.2, lambda: memcache.set('k', 'theirs')).start()
+        rv = single_flight.do('k', lambda: 'ours', lookup=lambda: memcache.get('k'))
+        assert rv == 'theirs'
+
+    def test_should_coalesce_concurrent_query_misses(self):
+        model_cache = ModelCache()
+        model_cache.init_config(dict(MODELS=dict(USER=dict(QUERY_CACHE_TIMEOUT=60))), [models.User])
+        models.User(name='foo').put()
+        # as if the write settled
+        memcache.delete(ModelCache.UNSETTLED_PREFIX + 'User')
+        queries = []
+        def fetch():
+            queries.append(1)
+            time.sleep(0.2)
+            return models.User.query().fetch()
+
+        results = self.run_concurrently(lambda: model_cache.query('User', 'all', fetch))
+        assert len(queries) == 1
+        assert all([u.name for u in r] == ['foo'] for r in results)
+        # waiting callers got their own copy
+        assert len(set(id(r) for r in results)) > 1
+
+    def test_should_stop_waiting_at_deadline(self):
+        single_flight = SingleFlight(lease_timeout=2)
+        memcache.add(SingleFlight.LEASE_PREFIX + 'k', True)
+        start = time.time()
+        with pytest.raises(datastore_errors.Timeout):
+            single_flight.do('k', lambda: 'ours', lookup=lambda: memcache.get('k'), deadline=0.2)
+        assert time.time() - start < 1
@@ -0,0 +1,98 @@
+import json
+import time
+
+from google.appengine.api import memcache
+from tests import BaseTestCase
+from server import api, models
+from server.budgets import latency_budgets
+from server.idempotency import idempotency_store, H_REPLAYED
+
+
+class TestIdempotency(BaseTestCase):
+    def create_app(self):
+        return api.create_app()
+
+    def create_user(self, client, key, name='foo'):
+        return client.post('/api/users', data=json.dumps(dict(name=name)),
+            headers=self.make_headers({'Idempotency-Key': key}))
+
+    def test_should_replay_response_to_retries(self, app, client):
+        first = self.create_user(client, 'k1')
+        retry = self.create_user(client, 'k1')
+        assert first.status_code == retry.status_code == 200
+        assert retry.get_data() == first.get_data()
+        assert retry.headers[H_REPLAYED] == 'true'
+        assert H_REPLAYED not in first.headers
+        assert models.User.query().count() == 1
+
+        self.create_user(client, 'k2')
+        assert models.User.query().count() == 2
+
+    def test_should_replay_from_datastore_when_evicted(self, app, client):
+        first = self.create_user(client, 'k1')
+        memcache.flush_all()
+        retry = self.create_user(client, 'k1')
+        assert retry.get_data() == first.get_data()
+        assert retry.headers[H_REPLAYED] == 'true'
+        assert models.User.query().count() == 1
+
+    def test_should_reject_key_reused_for_different_request(self, app, client):
+        self.create_user(client, 'k1')
+        resp = self.create_user(client, 'k1', name='bar')
+        assert resp.status_code == 422
+        assert models.User.query().count() == 1
+
+    def test_should_conflict_while_request_in_flight(self, app, client, monkeypatch):
+        # another request holds the key and never finishes in time
+        monkeypatch.setattr(idempotency_store, 'acquire', lambda id: False)
+        monkeypatch.setattr(idempotency_store, 'in_flight', lambda id: True)
+        monkeypatch.setattr(idempotency_store, 'wait', 0.2)
+        resp = self.create_user(client, 'k1')
+        assert resp.status_code == 409
+        assert 'Retry-After' in resp.headers
+        assert models.User.query().count() == 0
+
+    def test_should_run_unlocked_when_memcache_is_unavailable(self, app, client, monkeypatch):
+        monkeypatch.setattr(memcache, 'add', lambda *args, **kwargs: False)
+        monkeypatch.setattr(idempotency_store, 'wait', 5)
+        start = time.time()
+        first = self.create_user(client, 'k1')
+        assert first.status_code == 200
+        # didn't wait on a lock that was never taken
+        assert time.time() - start < 1
+        retry = self.create_user(client, 'k1')
+        assert retry.headers[H_REPLAYED] == 'true'
+        assert models.User.query().count() == 1
+
+    def test_should_only_wait_within_latency_budget(self, app, client, monkeypatch):
+        monkeypatch.setattr(idempotency_store, 'acquire', lambda id: False)
+        monkeypatch.setattr(idempotency_store, 'in_flight', lambda id: True)
+        monkeypatch.setattr(idempotency_store, 'wait', 5)
+        monkeypatch.setitem(latency_budgets.budgets, 'API_WRITE', (0.3, 'FAIL'))
+        start = time.time()
+        resp = self.create_user(client, 'k1')
+        assert resp.status_code == 409
+        assert time.time() - start < 1
+
+    def test_should_replay_response_too_large_for_memcache(self, app, client, monkeypatch):
+        set = memcache.set
+        def limited_set(key, value, **kwargs):
+            if key.startswith(idempotency_store.RESPONSE_PREFIX):
+                raise ValueError('Values may not be more than 1000000 bytes in length')
+            return set(key, value, **kwargs)
+        monkeypatch.setattr(memcache, 'set', limited_set)
+        first = self.create_user(client, 'k1')
+        assert models.IdempotentResponse.query().count() == 1
+
+        # the retry looked before the first request stored its response,
+        # and got the lock once it was done
+        get = idempotency_store.get
+        lookups = []
+        def late_get(id, use_datastore=True):
+            lookups.append(id)
+            return None if len(lookups) == 1 else get(id, use_datastore)
+        monkeypatch.setattr(idempotency_store, 'get', late_get)
+        retry = self.create_user(client, 'k1')
+        assert retry.headers[H_REPLAYED] == 'true'
+        assert retry.get_data() == first.get_data()
+        assert models.User.query().count() == 1
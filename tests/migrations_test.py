@@ -0,0 +1,148 @@
+import pytest
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from tests import BaseTestCase
+from server import api, models
+from server.migrations import core, MigrationRunner, MigrationException, split_key_range
+from server.migrations.versions import normalize_user_email
+
+
+class TestMigrationRunner(BaseTestCase):
+    def create_app(self):
+        return api.create_app()
+
+    @pytest.fixture
+    def users(self, app):
+        """Tests with this fixture have 50 users predating User.email_normalized.
+        """
+        ndb.put_multi([models.User(name='user%s' % n, email=' User%s@Acme.org' % n)
+            for n in range(50)])
+
+    @pytest.fixture
+    def runner(self, users):
+        """Fixture that provides a runner with the user email migration, shard
+        steps are collected in runner.pending rather than deferred.
+        """
+        runner = MigrationRunner()
+        runner.pending = []
+        # tiny batches and no time to spare, so shards span many invocations
+        runner.init_config(dict(BATCH_SIZE=4, TIME_LIMIT=0, SHARDS=4),
+            lambda shard: runner.pending.append((shard.key.id(), shard.invocations)))
+        runner.register(1, models.User, normalize_user_email)
+        return runner
+
+    def run_pending(self, runner):
+        # interleaves the shards, as if running in parallel
+        while runner.pending:
+            runner.step(*runner.pending.pop(0))
+
+    def test_should_split_kind_into_key_ranges(self, users):
+        splits = split_key_range(models.User, 4)
+        assert len(splits) == 3
+        bounds = [None] + splits + [None]
+        counts = []
+        for start, end in zip(bounds, bounds[1:]):
+            query = models.User.query()
+            if start:
+                query = query.filter(models.User.key >= start)
+            if end:
+                query = query.filter(models.User.key < end)
+            counts.append(query.count())
+        assert sum(counts) == 50
+        assert min(counts) > 0
+
+    def test_should_only_report_changes_on_dry_run(self, runner):
+        assert runner.start(1, dry_run=True) == 'started'
+        self.run_pending(runner)
+
+        report, = runner.report()
+        assert report['dry_run'].finished_at is not None
+        assert report['run'] is None
+        assert sum(s.changed for s in report['shards']) == 50
+        assert all(u.email_normalized is None for u in models.User.query())
+
+    def test_should_repeat_dry_run(self, runner):
+        runner.start(1, dry_run=True)
+        self.run_pending(runner)
+        first = models.Migration.get_by_id(models.Migration.make_id(1, dry_run=True))
+
+        assert runner.start(1, dry_run=True) == 'started'
+        assert len(runner.pending) == 4
+        self.run_pending(runner)
+
+        report, = runner.report()
+        assert report['dry_run'].started_at > first.started_at
+        assert report['dry_run'].finished_at is not None
+        assert sum(s.changed for s in report['shards']) == 50
+        # shards of the first dry run are gone
+        assert models.MigrationShard.query().count() == 4
+        assert runner.start(1, dry_run=True) == 'started'
+
+    def test_should_apply_migration_once(self, runner):
+        assert runner.start(1) == 'started'
+        # without a time limit every shard looks stalled, so they're enqueued
+        # again, the duplicates must not run
+        assert runner.start(1) == 'resumed'
+        assert len(runner.pending) == 8
+        self.run_pending(runner)
+
+        report, = runner.report()
+        assert report['run'].finished_at is not None
+        assert len(report['shards']) == 4
+        assert sum(s.processed for s in report['shards']) == 50
+        assert sum(s.changed for s in report['shards']) == 50
+        assert all(s.invocations > 1 for s in report['shards'])
+        assert all(s.to_plain()['processed_per_second'] > 0 for s in report['shards'])
+        ndb.get_context().clear_cache()
+        assert sorted(u.email_normalized for u in models.User.query()) == \
+            sorted('user%s@acme.org' % n for n in range(50))
+
+        with pytest.raises(MigrationException):
+            runner.start(1)
+
+    def test_should_skip_stale_invocations(self, runner):
+        runner.start(1)
+        shard_id, invocation = runner.pending[0]
+        runner.step(shard_id, invocation)
+        processed = models.MigrationShard.get_by_id(shard_id).processed
+        # e.g. a retried task, the shard already moved past it
+        runner.step(shard_id, invocation)
+        assert models.MigrationShard.get_by_id(shard_id).processed == processed
+
+    def test_should_retry_failed_batches(self, runner):
+        failures = []
+
+        def flaky_normalize(user):
+            if not failures:
+                failures.append(user)
+                raise datastore_errors.Timeout()
+            return normalize_user_email(user)
+        runner.migrations[1] = ('normalize_user_email', models.User, flaky_normalize)
+        runner.start(1)
+        shard_id, invocation = runner.pending.pop(0)
+        with pytest.raises(datastore_errors.Timeout):
+            runner.step(shard_id, invocation)
+        # the task queue retries the same invocation
+        runner.step(shard_id, invocation)
+        self.run_pending(runner)
+
+        report, = runner.report()
+        assert report['run'].finished_at is not None
+        assert sum(s.changed for s in report['shards']) == 50
+        assert all(s.claimed_at is None for s in report['shards'])
+
+    def test_should_only_split_new_runs(self, runner, monkeypatch):
+        calls = []
+
+        def split(model_class, shards):
+            calls.append(shards)
+            return split_key_range(model_class, shards)
+        monkeypatch.setattr(core, 'split_key_range', split)
+        runner.start(1)
+        runner.start(1)
+        assert calls == [4]
+        self.run_pending(runner)
+        with pytest.raises(MigrationException):
+            runner.start(1)
+        assert calls == [4]
@@ -0,0 +1,59 @@
+import cProfile
+import marshal
+import time
+import pytest
+
+from tests import BaseTestCase
+from server import api, models, profiler
+
+
+class TestProfiler(BaseTestCase):
+    def create_app(self):
+        return api.create_app()
+
+    def test_should_only_profile_requests_with_valid_token(self, app, client):
+        p = profiler.request_profiler
+        client.get('/api/users', headers={p.header: 'forged'})
+        assert p.report() == {}
+
+        for _ in range(p.ring_size + 5):
+            client.get('/api/users', headers={p.header: p.make_token()})
+
+        report = p.report(limit=5)
+        assert list(report) == ['GET /api/users']
+        # ring is capped
+        assert report['GET /api/users']['profiles'] == p.ring_size
+        assert len(report['GET /api/users']['hotspots']) == 5
+
+    def test_should_reject_tampered_and_expired_tokens(self, app, client, monkeypatch):
+        p = profiler.request_profiler
+        token = p.make_token()
+        client.get('/api/users', headers={p.header: token.replace('profile', 'Profile', 1)})
+        # signed with another key
+        other = profiler.Profiler()
+        other.init_config({}, 'not-the-secret')
+        client.get('/api/users', headers={p.header: other.make_token()})
+
+        monkeypatch.setattr(p.signer, 'get_timestamp',
+            lambda: int(time.time()) - p.token_max_age - 10)
+        expired = p.make_token()
+        monkeypatch.undo()
+        client.get('/api/users', headers={p.header: expired})
+        assert models.Profile.query().count() == 0
+
+    def test_should_store_profiles_in_ring_per_route(self, app, monkeypatch):
+        p = profiler.request_profiler
+        monkeypatch.setattr(p, 'ring_size', 2)
+        for n in range(3):
+            profile = cProfile.Profile()
+            profile.runcall(sum, range(10))
+            p.store('GET /foo', 0.1 * (n + 1), profile)
+
+        stored = sorted(models.Profile.query(), key=lambda s: s.key.id())
+        assert [s.key.id() for s in stored] == ['GET /foo:0', 'GET /foo:1']
+        # the third profile took the slot of the first
+        assert sorted(s.duration for s in stored) == pytest.approx([0.2, 0.3])
+        stats = marshal.loads(stored[0].stats)
+        assert any(func[2] == "<sum>" for func in stats)
+        assert all(len(stat) == 4 for stat in stats.values())
+        assert 'stats' not in stored[0].to_plain()
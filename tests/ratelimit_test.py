@@ -0,0 +1,83 @@
+import pytest
+
+from tests import BaseTestCase
+from server import api
+from server.ratelimit import TokenBucket, Limit, rate_limiter
+
+
+class TestTokenBucket(BaseTestCase):
+    def create_app(self):
+        return api.create_app()
+
+    @pytest.fixture(autouse=True)
+    def stubs(self, app):
+        """Memcache stub for each test.
+        """
+        pass
+
+    def test_should_allow_burst_then_deny(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        assert [bucket.take('k', now=100) for _ in range(3)] == [0, 0, 0]
+        assert bucket.take('k', now=100) == pytest.approx(1)
+
+    def test_should_refill_over_time(self):
+        bucket = TokenBucket(rate=2, burst=1)
+        assert bucket.take('k', now=100) == 0
+        assert bucket.take('k', now=100.25) == pytest.approx(0.25)
+        assert bucket.take('k', now=100.5) == 0
+
+    def test_should_keep_buckets_separate(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        assert bucket.take('a', now=100) == 0
+        assert bucket.take('b', now=100) == 0
+        assert bucket.take('a', now=100) > 0
+
+
+class TestLimit(BaseTestCase):
+    def create_app(self):
+        return api.create_app()
+
+    @pytest.fixture
+    def api_limit(self, app, monkeypatch):
+        """Tests with this fixture get a tight limit on the API routes, and
+        the number of times its bucket was consulted.
+        """
+        _limit = Limit('API', key='user', rate=0.1, burst=2, max_concurrent=1)
+        monkeypatch.setitem(rate_limiter.limits, 'API', _limit)
+        takes = []
+        take = _limit.bucket.take
+        def counting_take(*args, **kwargs):
+            takes.append(1)
+            return take(*args, **kwargs)
+        monkeypatch.setattr(_limit.bucket, 'take', counting_take)
+        _limit.takes = takes
+        return _limit
+
+    def test_should_turn_away_requests_over_limit(self, client, api_limit):
+        statuses = [client.get('/api/users', headers=self.make_headers()).status_code
+            for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        resp = client.get('/api/users', headers=self.make_headers())
+        assert resp.status_code == 429
+        assert 1 <= int(resp.headers['Retry-After']) <= 10
+        # the last denial was served from the in process deny cache
+        assert len(api_limit.takes) == 3
+
+    def test_should_shed_requests_over_concurrency_cap(self, client, api_limit):
+        # another request is in flight
+        api_limit.semaphore.acquire()
+        try:
+            resp = client.get('/api/users', headers=self.make_headers())
+        finally:
+            api_limit.semaphore.release()
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == '1'
+        assert client.get('/api/users', headers=self.make_headers()).status_code == 200
+
+    def test_should_bucket_signed_in_users_separately(self, client, api_limit):
+        for user in ['alice', 'bob']:
+            with client.session_transaction() as session:
+                session['user'] = user
+            statuses = [client.get('/api/users', headers=self.make_headers()).status_code
+                for _ in range(3)]
+            assert statuses == [200, 200, 429]
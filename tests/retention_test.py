@@ -0,0 +1,119 @@
+import datetime
+import pytest
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from tests import BaseTestCase
+from server import api, models, tasks
+from server.retention import retention, RetentionPolicy
+
+NOW = datetime.datetime.utcnow()
+
+
+class TestRetention(BaseTestCase):
+    def create_app(self):
+        return api.create_app()
+
+    @pytest.fixture
+    def runs(self, app):
+        """Tests with this fixture run retention tasks in process, as soon as
+        they're enqueued.
+        """
+        tasks.task_runner.init_config(dict(BACKEND='local', SYNCHRONOUS=True, RETRY_LIMIT=2))
+        # tiny batches and no time to spare, so runs span many invocations
+        retention.init_config(dict(BATCH_SIZE=2, TIME_LIMIT=0, MODELS=dict(
+            OAUTH=dict(MAX_AGE=3600, MAX_AGE_PROPERTY='created_at', ORPHANS=True),
+            SETTING=dict(PLACEHOLDERS=True))), models.AbstractModel.subclasses())
+
+    def create_oauth(self, identity, age=0, parent=None):
+        return models.OAuth.create(parent=parent or models.User.create().key,
+            identity=identity, provider_id='google', token=dict(access_token=identity),
+            created_at=NOW - datetime.timedelta(seconds=age))
+
+    def test_should_delete_entities_according_to_policies(self, runs):
+        fresh = [self.create_oauth('fresh-{}'.format(i)) for i in range(3)]
+        for i in range(3):
+            self.create_oauth('stale-{}'.format(i), age=7200)
+        for i in range(2):
+            self.create_oauth('orphan-{}'.format(i), parent=ndb.Key(models.User, 'gone'))
+        models.Setting.create(id='REMOVED_SETTING', value='__REPLACE_ME__')
+        placeholders = models.Setting.query(models.Setting.value == '__REPLACE_ME__').count()
+
+        assert retention.start() == dict(OAuth='started', Setting='started')
+
+        assert sorted(o.identity for o in models.OAuth.query()) == \
+            sorted(o.identity for o in fresh)
+        assert models.Setting.get_by_id('REMOVED_SETTING') is None
+        assert models.Setting.query().count() == placeholders - 1
+
+        oauth_run, setting_run = retention.report()
+        assert oauth_run.finished_at is not None
+        assert oauth_run.deleted == 5
+        # 3 stale, then all 5 remaining when looking for orphans
+        assert oauth_run.scanned == 8
+        assert oauth_run.invocations > 1
+        assert oauth_run.to_plain()['deleted_per_second'] > 0
+        assert setting_run.deleted == 1
+
+    def test_should_clear_stale_tokens_keeping_identities(self, runs, monkeypatch):
+        retention.init_config(dict(BATCH_SIZE=2, TIME_LIMIT=0, MODELS=dict(
+            OAUTH=dict(MAX_AGE=3600, MAX_AGE_PROPERTY='updated_at', MAX_AGE_CLEAR=['token']))),
+            models.AbstractModel.subclasses())
+        self.create_oauth('fresh')
+        monkeypatch.setattr(ndb.DateTimeProperty, '_now',
+            lambda self: NOW - datetime.timedelta(seconds=7200))
+        for i in range(3):
+            self.create_oauth('stale-{}'.format(i))
+        monkeypatch.undo()
+
+        assert retention.start() == dict(OAuth='started')
+
+        tokens = dict((o.identity, o.token) for o in models.OAuth.query())
+        assert tokens == {'fresh': dict(access_token='fresh'),
+            'stale-0': None, 'stale-1': None, 'stale-2': None}
+        assert models.User.query().count() == 4
+        run = models.RetentionRun.get_by_id('OAuth')
+        assert (run.deleted, run.cleared) == (0, 3)
+
+    def test_should_retry_failed_batches(self, runs, monkeypatch):
+        for i in range(3):
+            self.create_oauth('stale-{}'.format(i), age=7200)
+        prune = RetentionPolicy.prune
+        failures = []
+
+        def flaky_prune(policy, model_class, keys, run):
+            if not failures:
+                failures.append(keys)
+                raise datastore_errors.Timeout()
+            return prune(policy, model_class, keys, run)
+        monkeypatch.setattr(RetentionPolicy, 'prune', flaky_prune)
+
+        retention.start(['OAuth'])
+
+        assert failures
+        assert models.OAuth.query().count() == 0
+        run = models.RetentionRun.get_by_id('OAuth')
+        assert run.finished_at is not None
+        assert run.deleted == 3
+        assert run.claimed_at is None
+
+    def test_should_skip_stale_invocations(self, runs):
+        self.create_oauth('stale', age=7200)
+        retention.start(['OAuth'])
+        run = models.RetentionRun.get_by_id('OAuth')
+        finished_at = run.finished_at
+        # e.g. a retried task, the run already moved past it
+        retention.step('OAuth', 0)
+        assert models.RetentionRun.get_by_id('OAuth').finished_at == finished_at
+        assert retention.start(['OAuth']) == dict(OAuth='started')
+
+    def test_should_leave_invocations_in_progress_to_their_task(self, runs, monkeypatch):
+        monkeypatch.setattr(retention, 'time_limit', 60)
+        self.create_oauth('stale', age=7200)
+        run = models.RetentionRun(id='OAuth', started_at=NOW,
+            claimed_at=datetime.datetime.utcnow())
+        run.put()
+        # a duplicate of the task holding the invocation is retried later
+        with pytest.raises(tasks.TaskException):
+            retention.step('OAuth', 0)
+        assert models.OAuth.query().count() == 1
@@ -0,0 +1,90 @@
+import pytest
+
+from server.tasks import TaskRunner, PermanentTaskFailure
+from server.tasks import core, constants
+
+
+class TestTaskRunner(object):
+    @pytest.fixture
+    def runner(self):
+        """Fixture that provides a runner with a synchronous local backend.
+        """
+        runner = TaskRunner()
+        runner.init_config(dict(BACKEND='local', RETRY_LIMIT=2, SYNCHRONOUS=True))
+        return runner
+
+    @pytest.fixture
+    def calls(self, runner):
+        """Tests with this fixture have an 'echo' and a 'flaky' task registered,
+        each recording their calls.
+        """
+        calls = []
+        def flaky(n):
+            calls.append(n)
+            if len(calls) < 3:
+                raise ValueError('try again')
+        runner.register('echo', lambda *args, **kwargs: calls.append((args, kwargs)))
+        runner.register('flaky', flaky)
+        return calls
+
+    def test_should_run_enqueued_task(self, runner, calls):
+        runner.enqueue('echo', [1, 2], dict(a='b'))
+        assert calls == [((1, 2), dict(a='b'))]
+
+    def test_should_retry_failed_task(self, runner, calls):
+        runner.enqueue('flaky', [7])
+        assert calls == [7, 7, 7]
+
+    def test_should_only_run_named_task_once(self, runner, calls):
+        runner.enqueue('echo', [1], task_name='only-once')
+        runner.enqueue('echo', [2], task_name='only-once')
+        assert calls == [((1,), {})]
+
+    def test_should_hold_tasks_until_batch_completes(self, runner, calls):
+        with runner.batch():
+            runner.enqueue('echo', [1])
+            runner.enqueue('echo', [2])
+            assert calls == []
+        assert calls == [((1,), {}), ((2,), {})]
+
+    def test_should_run_tasks_on_worker_thread(self, calls):
+        runner = TaskRunner()
+        runner.init_config(dict(BACKEND='local'))
+        runner.register('echo', lambda n: calls.append(n))
+        for n in range(5):
+            runner.enqueue('echo', [n])
+        runner.drain()
+        assert calls == range(5)
+
+    def test_should_reject_unknown_task(self, runner):
+        with pytest.raises(PermanentTaskFailure):
+            runner.enqueue('unknown')
+
+    def test_should_back_off_between_retries(self, runner, calls, monkeypatch):
+        delays = []
+        monkeypatch.setattr(core.time, 'sleep', delays.append)
+        runner.config['RETRY_DELAY'] = 0.5
+        runner.enqueue('flaky', [7])
+        assert calls == [7, 7, 7]
+        assert delays == [0.5, 1.0]
+
+    def test_should_forget_oldest_task_names(self, runner, calls, monkeypatch):
+        monkeypatch.setattr(constants, 'NAMES_LIMIT', 2)
+        for name in ['a', 'b', 'c', 'a']:
+            runner.enqueue('echo', [name], task_name=name)
+        assert calls == [(('a',), {}), (('b',), {}), (('c',), {}), (('a',), {})]
+
+    @pytest.mark.parametrize('server_software,backend', [
+        ('Google App Engine/1.9.71', core.PushTaskBackend),
+        ('Development/2.0', core.PushTaskBackend),
+        ('Development/1.0 (testbed)', core.LocalTaskBackend),
+        (None, core.LocalTaskBackend),
+    ])
+    def test_should_pick_backend_for_server(self, server_software, backend, monkeypatch):
+        if server_software is None:
+            monkeypatch.delenv('SERVER_SOFTWARE', raising=False)
+        else:
+            monkeypatch.setenv('SERVER_SOFTWARE', server_software)
+        runner = TaskRunner()
+        runner.init_config(dict(BACKEND='auto'))
+        assert isinstance(runner.backend, backend)
@@ -0,0 +1,36 @@
+import json
+import pytest
+
+from google.appengine.api import memcache
+from tests import BaseTestCase
+from server import frontend, models, warmup
+from server.cache import model_cache
+
+
+class TestWarmup(BaseTestCase):
+    def create_app(self):
+        return frontend.create_app()
+
+    def test_should_run_each_warmup_step(self, app, client):
+        models.User.create(name='foo')
+        # as if the write settled
+        memcache.delete(model_cache.UNSETTLED_PREFIX + 'User')
+
+        resp = client.get('/_ah/warmup')
+        assert resp.status_code == 200
+        timings = json.loads(resp.get_data())
+        assert sorted(timings) == sorted(name for name, _ in warmup.STEPS)
+        assert all(t is not None for t in timings.values())
+        # the first page of users is primed
+        queries = []
+        assert [u.name for u in model_cache.query('User', 'list:None:50',
+            lambda: queries.append(1))] == ['foo']
+        assert queries == []
+
+    def test_should_skip_failing_step(self, app, monkeypatch):
+        def fail():
+            raise ValueError('nope')
+        monkeypatch.setattr(warmup, 'STEPS', [('fails', fail), ('cache', warmup._prime_cache)])
+        timings = warmup.warmup()
+        assert timings['fails'] is None
+        assert timings['cache'] is not None